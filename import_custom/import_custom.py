@@ -8,7 +8,8 @@ try:
 except ImportError:
     pass
 
-from openerp.addons.import_framework.import_base import import_base
+from openerp.addons.import_framework.import_base import import_base, adaptive_split
+from openerp.addons.import_framework.csv_source import csv_source
 
 try:
     from pandas import merge, DataFrame
@@ -22,12 +23,6 @@ import re
 import time
 import datetime as DT
 
-try:
-    from cStringIO import StringIO
-except ImportError:
-    from StringIO import StringIO
-import csv
-
 import glob
 from openerp.osv.fields import sanitize_binary_value
 
@@ -90,24 +85,22 @@ class import_custom(import_base):
                                     #'quoting':''
                                     })
     def get_data(self, table):
+        """
+            @return: DataFrame, see import_framework.csv_source
+        """
         file_name = filter(lambda f: f.endswith('/%s.csv' % table), self.csv_files)
         if file_name:
             _logger.info('read file "%s"' % ( '%s.csv' % table))
             file_name = file_name[0]
         else:
             _logger.info('file not found %s' % ( '%s.csv' % table))
-            return []
+            return DataFrame()
 
-        with open(file_name, 'rb') as csvfile:
-            fixed_file = StringIO(csvfile.read() .replace('\r\n', '\n'))
-        reader = csv.DictReader(fixed_file,
+        source = csv_source(file_name,
                             delimiter = self.import_options.get('separator'),
-                            #quotechar = self.import_options.get('quoting'),
+                            line_num_column = self.COL_LINE_NUM,
                             )
-        res = list(reader)
-        for line_num, line in enumerate(res):
-            line[self.COL_LINE_NUM] = str(line_num)
-        return res
+        return source.read()
     def get_mapping(self):
         return [
             self.get_mapping_partners(),
@@ -255,7 +248,7 @@ class import_custom(import_base):
                 },
 
                 {'model' : 'product.product',
-                 'split' : 1000,
+                 'split' : adaptive_split(seconds=60, start=1000),
                  'fields': {
                      'id': xml_id(self.TABLE_PRODUCT, 'ID'),
                      'categ_id/id': xml_id(self.TABLE_PRODUCT + '_brand', 'Brand'),
@@ -40,9 +40,16 @@ class import_custom_upload(osv.TransientModel):
 
         record = self.browse(cr, uid, ids[0])
 
-
-
-        tmp_dir,files = self.unzip_file(record.file.strip(), pattern='*.csv')
+        # import is run in background, see import_framework.job
+        return self.pool['import_framework.job'].enqueue(cr, uid, 'import_custom', self._name, 'import_job',
+                                                         {'file': record.file},
+                                                         context=context)
+
+    def import_job(self, cr, uid, params, context=None):
+        """
+            @return: import_custom instance for import_framework.job
+        """
+        tmp_dir,files = self.unzip_file(params['file'].strip(), pattern='*.csv')
         _logger.info('files: %s'%files)
 
         instance = import_custom(self.pool, cr, uid,
@@ -50,16 +57,10 @@ class import_custom_upload(osv.TransientModel):
                                    'import_custom', # module_name
                                     run_import=False,
                                  import_dir = '/home/tmp/',
+                                 resume=params.get('resume', False),
                                   context={'csv_files': files},
                                    )
-
-        instance.run()
-
-        try:
-            shutil.rmtree(tmp_dir)
-        except:
-            pass
-
+        instance.cleanup = lambda: shutil.rmtree(tmp_dir, ignore_errors=True)
         return instance
 
 
@@ -1,2 +1,3 @@
 import import_base
 import mapper
+import models
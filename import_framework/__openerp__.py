@@ -9,12 +9,17 @@
 Depends on:
 
 * http://pandas.pydata.org/
+
+Long imports can be run as background jobs (Settings >> Technical >> Import jobs),
+they are started by cron, so server's limit_time_real for cron workers has to be big enough.
     """,
     "external_dependencies": {
         'python': ['pandas']
     },
     'depends' : ['base'],
     'data':[
+        'security/ir.model.access.csv',
+        'views/job.xml',
         ],
     'installable': False,
     'auto_install': False,
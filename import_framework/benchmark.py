@@ -0,0 +1,452 @@
+# -*- coding: utf-8 -*-
+"""
+Synthetic benchmark of the import_framework mapping layer.
+
+It doesn't need a database or an external source: tables are generated
+in memory and odoo registry and cursor are replaced by in-process fakes
+(fake_pool, fake_cursor). Only the openerp package has to be importable
+(mapper uses openerp.tools), e.g. run it from odoo source directory:
+
+    python /path/to/import_framework/benchmark.py --rows 100000 --columns 20
+
+Reported for each scenario: rows/sec and peak memory (maxrss) of the process.
+"""
+import argparse
+import csv
+import json
+import random
+import re
+import resource
+import time
+import logging
+_logger = logging.getLogger(__name__)
+
+try:
+    from cStringIO import StringIO
+except ImportError:
+    from StringIO import StringIO
+
+try:
+    from pandas import DataFrame
+except ImportError:
+    pass
+
+from import_base import import_base
+from mapper import *
+
+
+class fake_record(object):
+    def __init__(self, model, vals):
+        self._model = model
+        self._vals = vals
+
+    def __getattr__(self, name):
+        value = self._vals.get(name)
+        column = self._model.many2one.get(name)
+        if column:
+            return self._model.pool[column].browse(None, None, value)
+        return value
+
+
+class fake_model(object):
+    """
+        In-memory model, supports domains of (field, '=' | '!=' | 'in', value)
+    """
+    def __init__(self, pool, name, many2one=None):
+        self.pool = pool
+        self._name = name
+        self.many2one = many2one or {}
+        self.records = {}
+        self.next_id = 1
+
+    def _match(self, vals, domain):
+        for field, op, value in domain:
+            v = vals.get(field)
+            if op == '=' and v != value \
+               or op == '!=' and v == value \
+               or op == 'in' and v not in value:
+                return False
+        return True
+
+    def create(self, cr, uid, vals, context=None):
+        id = self.next_id
+        self.next_id += 1
+        vals = dict(vals, id=id)
+        self.records[id] = vals
+        return id
+
+    def search(self, cr, uid, domain, offset=0, limit=None, order=None, context=None, count=False):
+        ids = [id for id, vals in sorted(self.records.iteritems()) if self._match(vals, domain)]
+        if count:
+            return len(ids)
+        return ids[offset:limit and offset + limit or None]
+
+    def read(self, cr, uid, ids, fields=None, context=None):
+        return [dict((f, self.records[id].get(f)) for f in (fields or self.records[id].keys()) + ['id'])
+                for id in ids]
+
+    def write(self, cr, uid, ids, vals, context=None):
+        for id in ids:
+            self.records[id].update(vals)
+        return True
+
+    def unlink(self, cr, uid, ids, context=None):
+        for id in ids:
+            del self.records[id]
+        return True
+
+    def browse(self, cr, uid, id, context=None):
+        if isinstance(id, list):
+            return [self.browse(cr, uid, i) for i in id]
+        return fake_record(self, self.records.get(id, {'id': id}))
+
+
+class fake_ir_model_data(fake_model):
+    def __init__(self, pool, name):
+        super(fake_ir_model_data, self).__init__(pool, name)
+        self.by_name = {}
+
+    def create(self, cr, uid, vals, context=None):
+        id = super(fake_ir_model_data, self).create(cr, uid, vals, context=context)
+        self.by_name[(vals.get('module') or '', vals['name'])] = vals['res_id']
+        return id
+
+    def xmlid_to_res_id(self, cr, uid, xmlid, raise_if_not_found=False):
+        module, name = xmlid.split('.', 1)
+        return self.by_name.get((module, name), False)
+
+
+class fake_config_parameter(fake_model):
+    def get_param(self, cr, uid, key, default=False, context=None):
+        return self.pool.params.get(key, default)
+
+
+class fake_base_import(fake_model):
+    """
+        Parses the csv and creates records of res_model and their external ids
+    """
+    def do(self, cr, uid, id, fields, options, dryrun=False, context=None):
+        imp = self.records[id]
+        model = self.pool.get(imp['res_model'])
+        reader = csv.reader(StringIO(imp['file']),
+                            delimiter=options.get('separator'),
+                            quotechar=options.get('quoting'))
+        header = next(reader)
+        for row in reader:
+            vals = dict(zip(header, row))
+            xml_id = vals.pop('id', None)
+            if model is None:
+                continue
+            res_id = model.create(cr, uid, vals)
+            if xml_id:
+                module, name = '.' in xml_id and xml_id.split('.', 1) or ('', xml_id)
+                self.pool['ir.model.data'].create(cr, uid, {'module': module,
+                                                            'name': name,
+                                                            'model': imp['res_model'],
+                                                            'res_id': res_id})
+        return []
+
+
+class fake_cursor(object):
+    """
+        Understands only the queries which import_framework sends itself,
+        see fake_pool.sql_handlers
+    """
+    def __init__(self, pool):
+        self.pool = pool
+        self.dbname = 'benchmark'
+        self.result = []
+        self.queries = 0
+
+    def execute(self, query, params=None):
+        self.queries += 1
+        query = ' '.join(query.split())
+        for pattern, handler in self.pool.sql_handlers:
+            if re.match(pattern, query):
+                self.result = handler(*(params or ()))
+                return
+        raise NotImplementedError('fake_cursor: %s' % query)
+
+    def fetchall(self):
+        return self.result
+
+    def fetchone(self):
+        return self.result and self.result[0] or None
+
+    def copy_expert(self, sql, f):
+        f.read()
+
+    def commit(self):
+        pass
+
+    def rollback(self):
+        pass
+
+    def close(self):
+        pass
+
+
+class fake_pool(dict):
+    def __init__(self):
+        super(fake_pool, self).__init__()
+        self.params = {}
+        self['ir.model.data'] = fake_ir_model_data(self, 'ir.model.data')
+        self['ir.config_parameter'] = fake_config_parameter(self, 'ir.config_parameter')
+        self['base_import.import'] = fake_base_import(self, 'base_import.import')
+        for name in ['res.partner', 'res.country', 'mail.message', 'import_framework.checkpoint']:
+            self[name] = fake_model(self, name)
+        self['res.users'] = fake_model(self, 'res.users', many2one={'partner_id': 'res.partner'})
+
+        data = self['ir.model.data']
+        self.sql_handlers = [
+            (r'SELECT max\(id\) FROM ir_model_data$',
+             lambda: [(max(data.records) if data.records else None,)]),
+            (r'SELECT name, res_id FROM ir_model_data WHERE module=%s$',
+             lambda module: [(r['name'], r['res_id']) for r in data.records.itervalues()
+                             if (r.get('module') or '') == module]),
+            (r'SELECT module, name, res_id FROM ir_model_data WHERE id > %s AND module IN %s$',
+             lambda last_id, modules: [(r.get('module') or '', r['name'], r['res_id'])
+                                       for r in data.records.itervalues()
+                                       if r['id'] > last_id and (r.get('module') or '') in modules]),
+            # email_index, write_date and IN filters are ignored: all records are returned again
+            (r"SELECT value FROM ir_config_parameter WHERE key='mail.catchall.domain'$",
+             lambda: [(self.params.get('mail.catchall.domain'),)]),
+            (r"SELECT \(now\(\) at time zone 'UTC'\)$",
+             lambda: [(time.strftime('%Y-%m-%d %H:%M:%S'),)]),
+            (r'SELECT lower\(p.email\), p.id FROM res_partner p ',
+             lambda *since: [(r['email'].lower(), r['id'])
+                             for r in sorted(self['res.partner'].records.itervalues(),
+                                             key=lambda r: (r.get('name'), r['id']))
+                             if r.get('email')]),
+            (r'SELECT p.id, lower\(p.email\) FROM res_partner p ',
+             lambda *since: [(r['id'], (r.get('email') or '').lower() or None)
+                             for r in self['res.partner'].records.itervalues()]),
+            (r'SELECT u.partner_id, a.alias_name FROM res_users u ',
+             lambda *since: [(r['partner_id'], r.get('alias_name'))
+                             for r in self['res.users'].records.itervalues()]),
+            (r'SELECT a.alias_name, u.partner_id FROM res_users u ',
+             lambda *since: [(r['alias_name'], r['partner_id'])
+                             for r in sorted(self['res.users'].records.itervalues(),
+                                             key=lambda r: r.get('login'))
+                             if r.get('alias_name')]),
+        ]
+
+    def cursor(self):
+        return fake_cursor(self)
+
+
+COUNTRIES = ['United Kingdom', 'France', 'Germany', 'Spain', 'UK', 'Italy', 'Netherlands', '']
+STATUSES = ['Prospect', 'Pipeline', 'Archived', 'Dorment', 'Live Contact', '']
+
+
+def synthetic_table(rows, columns=10, text_size=20, null_ratio=0.1, parents=0, users=10, prefix='r', seed=0):
+    """
+        @param columns: number of extra text columns c0..cN
+        @param parents: number of rows in the parent table (for parent_id), 0 to skip
+        @return: DataFrame with rows like SugarCRM tables
+    """
+    rnd = random.Random(seed)
+    alphabet = 'abcdefghijklmnopqrstuvwxyz     '
+
+    def text():
+        if rnd.random() < null_ratio:
+            return None
+        return ''.join(rnd.choice(alphabet) for i in range(text_size))
+
+    res = []
+    for i in xrange(rows):
+        row = {
+            'id': '%s%s' % (prefix, i),
+            'first_name': text(),
+            'last_name': text(),
+            'email': rnd.random() < null_ratio and None or 'Partner%s@Example.com' % i,
+            'to_addrs': ', '.join('partner%s@example.com' % rnd.randrange(rows) for j in range(3))
+                        + ', user%s@alias.example.com' % rnd.randrange(users),
+            'country': rnd.choice(COUNTRIES),
+            'status': rnd.choice(STATUSES),
+            'login': 'user%s' % rnd.randrange(users),
+            'date_entered': '2014-%02d-%02d 10:00:00' % (rnd.randint(1, 12), rnd.randint(1, 28)),
+            'tags': '^%s^,^%s^' % (rnd.choice(STATUSES), rnd.choice(COUNTRIES)),
+            'deleted': rnd.randint(0, 1),
+        }
+        if parents:
+            row['parent_id'] = 'p%s' % rnd.randrange(parents)
+        for c in range(columns):
+            row['c%s' % c] = text()
+        res.append(row)
+    return DataFrame(res)
+
+
+class benchmark_import(import_base):
+    TABLE_PARENT = 'parents'
+    TABLE_CHILD = 'children'
+
+    def initialize(self):
+        self.tables = self.context.get('tables')
+
+    def get_mapping(self):
+        return [self.get_mapping_parent(), self.get_mapping_child()]
+
+    def table(self, name):
+        return lambda: self.tables[name]
+
+    def get_mapping_parent(self):
+        return {
+            'name': self.TABLE_PARENT,
+            'table': self.table(self.TABLE_PARENT),
+            'models': [{
+                'model': 'res.partner',
+                'vectorize': self.vectorize,
+                'fields': {
+                    'id': xml_id(self.TABLE_PARENT, 'id'),
+                    'name': concat('first_name', 'last_name'),
+                    'email': first('email', 'c0', lower=True),
+                    'comment': value('c1', fallback='c2', default='-'),
+                    'stage': map_val('status', {'Prospect': 'new', 'Pipeline': 'open'}, 'draft'),
+                    'date': fixdate('date_entered'),
+                    'ref': clean_sugar('tags'),
+                    'customer': const('1'),
+                    'active': lambda record: not record['deleted'],
+                    'country_id/.id': country_by_name('country'),
+                    'user_id/.id': user_by_login('login'),
+                }
+            }]
+        }
+
+    def get_mapping_child(self):
+        return {
+            'name': self.TABLE_CHILD,
+            'table': self.table(self.TABLE_CHILD),
+            'dependencies': [self.TABLE_PARENT],
+            'models': [{
+                'model': 'mail.message',
+                'vectorize': self.vectorize,
+                'fields': {
+                    'id': xml_id(self.TABLE_CHILD, 'id'),
+                    'subject': concat('first_name', 'last_name', delimiter=' * '),
+                    'body': call(lambda vals, body: body or '', value('c0')),
+                    'parent_ref': ref(self.TABLE_PARENT, 'parent_id'),
+                    'res_id': res_id(const(self.TABLE_PARENT), 'parent_id'),
+                    'notified_partner_ids/.id': emails2partners('to_addrs'),
+                }
+            }]
+        }
+
+
+def fill_pool(pool, users, countries=COUNTRIES):
+    for name in countries:
+        if name:
+            pool['res.country'].create(None, None, {'name': name})
+    for i in range(users):
+        partner_id = pool['res.partner'].create(None, None, {'name': 'user%s' % i,
+                                                            'email': 'user%s@example.com' % i})
+        pool['res.users'].create(None, None, {'login': 'user%s' % i,
+                                              'alias_name': 'user%s' % i,
+                                              'partner_id': partner_id})
+    pool.params['mail.catchall.domain'] = 'alias.example.com'
+
+
+def maxrss_mb():
+    # kilobytes on linux
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024.0
+
+
+def measure(name, rows, func):
+    start = time.time()
+    func()
+    seconds = time.time() - start
+    res = {'scenario': name,
+           'rows': rows,
+           'seconds': seconds,
+           'rows_per_sec': seconds and rows / seconds or 0,
+           'maxrss_mb': maxrss_mb(),
+           }
+    _logger.info('%(scenario)s: %(rows)s rows, %(seconds).2fs, %(rows_per_sec).0f rows/sec, maxrss %(maxrss_mb).1f MB' % res)
+    return res
+
+
+def run_benchmark(rows=10000, columns=10, text_size=20, null_ratio=0.1, users=10,
+                  chunk_size=10000, vectorize=False, profile=False):
+    parents = max(rows / 10, 1)
+    tables = {
+        benchmark_import.TABLE_PARENT: synthetic_table(parents, columns, text_size, null_ratio,
+                                                       users=users, prefix='p'),
+        benchmark_import.TABLE_CHILD: synthetic_table(rows, columns, text_size, null_ratio,
+                                                      parents=parents, users=users, prefix='c', seed=1),
+    }
+
+    def instance(**kwargs):
+        pool = fake_pool()
+        fill_pool(pool, users)
+        return benchmark_import(pool, pool.cursor(), 1, 'benchmark', 'import_framework',
+                                import_dir=None,
+                                chunk_size=chunk_size,
+                                vectorize=vectorize,
+                                profile=profile,
+                                context={'tables': tables},
+                                **kwargs)
+
+    results = []
+
+    bench = instance(run_import=False)
+    mapping = bench.prepare_mapping(bench.get_mapping())
+    parent_model = mapping[bench.TABLE_PARENT]['models'][0]
+    parent_table = tables[bench.TABLE_PARENT]
+    child_model = mapping[bench.TABLE_CHILD]['models'][0]
+    child_table = tables[bench.TABLE_CHILD]
+
+    results.append(measure('_preprocess_mapping', 1000,
+                           lambda: [bench._preprocess_mapping(dict(parent_model['fields'])) for i in xrange(1000)]))
+
+    mfields = bench._preprocess_mapping(parent_model['fields'])
+    parent_dicts = [dict(r) for i, r in parent_table.iterrows()]
+    results.append(measure('_fields_mapp', len(parent_dicts),
+                           lambda: [bench._fields_mapp(d, mfields) for d in parent_dicts]))
+    builder = bench.get_row_builder(parent_model)
+    results.append(measure('row_builder', len(parent_dicts),
+                           lambda: [builder.build(d) for d in parent_dicts]))
+
+    results.append(measure('do_mapping', len(parent_table),
+                           lambda: bench.do_mapping(parent_table, parent_model)))
+
+    # dbmapper paths: ref, res_id, emails2partners against imported parents
+    bench = instance()
+    bench.mapping = bench.prepare_mapping(bench.get_mapping())
+    bench.map_and_import(bench.mapping[bench.TABLE_PARENT])
+    bench.run_import = False
+    child_model = bench.mapping[bench.TABLE_CHILD]['models'][0]
+    results.append(measure('do_mapping (dbmapper)', len(child_table),
+                           lambda: bench.do_mapping(child_table, child_model)))
+
+    bench = instance()
+    results.append(measure('run', len(parent_table) + len(child_table), bench.run))
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark of import_framework mapping layer')
+    parser.add_argument('--rows', type=int, default=10000, help='rows in the child table (parent table has rows/10)')
+    parser.add_argument('--columns', type=int, default=10, help='extra text columns')
+    parser.add_argument('--text-size', type=int, default=20)
+    parser.add_argument('--null-ratio', type=float, default=0.1)
+    parser.add_argument('--users', type=int, default=10)
+    parser.add_argument('--chunk-size', type=int, default=10000)
+    parser.add_argument('--vectorize', action='store_true')
+    parser.add_argument('--profile', action='store_true')
+    parser.add_argument('--json', help='save results to the file')
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO)
+    results = run_benchmark(rows=args.rows, columns=args.columns, text_size=args.text_size,
+                            null_ratio=args.null_ratio, users=args.users, chunk_size=args.chunk_size,
+                            vectorize=args.vectorize, profile=args.profile)
+    print '%-25s %10s %10s %12s %10s' % ('scenario', 'rows', 'seconds', 'rows/sec', 'maxrss MB')
+    for r in results:
+        print '%(scenario)-25s %(rows)10s %(seconds)10.2f %(rows_per_sec)12.0f %(maxrss_mb)10.1f' % r
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump(results, f, indent=2)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,87 @@
+# -*- coding: utf-8 -*-
+import csv
+import logging
+_logger = logging.getLogger(__name__)
+
+try:
+    from pandas import DataFrame
+except ImportError:
+    pass
+
+
+class csv_source(object):
+    """
+        Streaming reader of CSV file with header.
+
+        File is read line by line: '\\r\\n' is replaced with '\\n' per line
+        and rows are numbered through the whole file (0 for the first row
+        after header), the number is put to line_num_column as string.
+        Missed values of short rows are None.
+
+        Use:
+            source = csv_source(file_name, delimiter=',', line_num_column='line_num')
+            for chunk in source.iter_chunks(10000):
+                ... # DataFrame
+            t = source.read() # whole file as DataFrame
+    """
+    def __init__(self, file_name, delimiter=',', line_num_column=None):
+        self.file_name = file_name
+        self.delimiter = delimiter
+        self.line_num_column = line_num_column
+
+    def _lines(self, csvfile):
+        for line in csvfile:
+            yield line.replace('\r\n', '\n')
+
+    def iter_rows(self):
+        """
+            @return: header (list of columns), then lists of values
+        """
+        with open(self.file_name, 'rb') as csvfile:
+            reader = csv.reader(self._lines(csvfile), delimiter=self.delimiter)
+            header = next(reader, None)
+            if header is None:
+                return
+            size = len(header)
+            if self.line_num_column:
+                header = header + [self.line_num_column]
+            yield header
+            line_num = 0
+            for row in reader:
+                if not row:
+                    continue
+                if len(row) < size:
+                    row = row + [None] * (size - len(row))
+                elif len(row) > size:
+                    row = row[:size]
+                if self.line_num_column:
+                    row.append(str(line_num))
+                line_num += 1
+                yield row
+
+    def iter_chunks(self, chunk_size):
+        """
+            @return: iterator of DataFrames of chunk_size rows
+        """
+        rows = self.iter_rows()
+        columns = next(rows, None)
+        if columns is None:
+            return
+        chunk = []
+        for row in rows:
+            chunk.append(row)
+            if len(chunk) >= chunk_size:
+                yield DataFrame(chunk, columns=columns)
+                chunk = []
+        if chunk:
+            yield DataFrame(chunk, columns=columns)
+
+    def read(self):
+        """
+            @return: DataFrame
+        """
+        rows = self.iter_rows()
+        columns = next(rows, None)
+        if columns is None:
+            return DataFrame()
+        return DataFrame(list(rows), columns=columns)
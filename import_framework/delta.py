@@ -0,0 +1,128 @@
+# -*- coding: utf-8 -*-
+from openerp import tools
+import hashlib
+from collections import OrderedDict
+import logging
+_logger = logging.getLogger(__name__)
+
+try:
+    from pandas import DataFrame, concat
+except ImportError:
+    pass
+
+from bulk_load import copy_escape, copy_rows
+
+
+def _records(records):
+    """
+        @return: iterator of dicts for DataFrame or list of dicts
+    """
+    if isinstance(records, DataFrame):
+        columns = list(records.columns)
+        return (dict(zip(columns, row)) for row in records.itertuples(index=False))
+    return iter(records)
+
+
+def row_fingerprint(row):
+    """
+        md5 of the row values, ordered by column name
+    """
+    data = u'\x1f'.join(u'%s=%s' % (tools.ustr(key), tools.ustr(row[key])) for key in sorted(row))
+    return hashlib.md5(data.encode('utf-8')).hexdigest()
+
+
+def compute_fingerprints(records, external_id):
+    """
+        Rows with the same external id (e.g. one row per email of a contact)
+        get one fingerprint of all of them in order, so they are kept
+        or skipped together.
+        @param external_id: name of the column with external id
+        @return: (list of external ids in order of records, OrderedDict {external id: fingerprint})
+                 or None if some row has no external id
+    """
+    ids = []
+    hashes = OrderedDict()
+    for row in _records(records):
+        id = row.get(external_id)
+        if id is None or id == '' or id != id:
+            return None
+        id = tools.ustr(id)
+        ids.append(id)
+        hashes.setdefault(id, hashlib.md5()).update(row_fingerprint(row))
+    return ids, OrderedDict((id, h.hexdigest()) for id, h in hashes.items())
+
+
+def align_chunks(chunks, external_id):
+    """
+        Move trailing rows of the last external id of each DataFrame chunk
+        to the next chunk, so all rows of an external id are fingerprinted
+        together (rows are supposed to be ordered by external id)
+        @return: iterator of DataFrames
+    """
+    pending = None
+    for chunk in chunks:
+        if pending is not None:
+            chunk = concat([pending, chunk], ignore_index=True)
+            pending = None
+        if external_id not in chunk.columns or not len(chunk):
+            yield chunk
+            continue
+        ids = chunk[external_id].values
+        start = len(ids) - 1
+        while start > 0 and ids[start - 1] == ids[-1]:
+            start -= 1
+        if start == 0:
+            # the whole chunk is one external id
+            pending = chunk
+            continue
+        pending = chunk[start:].reset_index(drop=True)
+        yield chunk[:start]
+    if pending is not None:
+        yield pending
+
+
+class fingerprint_store(object):
+    """
+        Fingerprints of imported rows per (instance, table, external id),
+        stored in import_framework.fingerprint
+    """
+    def __init__(self, cr, instance_name):
+        self.cr = cr
+        self.instance_name = instance_name
+
+    def load(self, table):
+        """
+            @return: {external id: fingerprint}
+        """
+        self.cr.execute('SELECT external_id, fingerprint FROM import_framework_fingerprint '
+                        'WHERE instance_name=%s AND table_name=%s', (self.instance_name, table))
+        return dict(self.cr.fetchall())
+
+    def save(self, table, fingerprints, uid=None):
+        """
+            insert or update fingerprints
+            @param fingerprints: list of (external id, fingerprint)
+        """
+        if not fingerprints:
+            return
+        fingerprints = dict(fingerprints)
+        cr = self.cr
+        cr.execute('CREATE TEMP TABLE import_framework_fingerprint_tmp '
+                   '(external_id varchar, fingerprint varchar) ON COMMIT DROP')
+        copy_rows(cr, 'import_framework_fingerprint_tmp', ['external_id', 'fingerprint'],
+                  ([copy_escape(id, null=False), fingerprint] for id, fingerprint in fingerprints.iteritems()))
+        cr.execute('DELETE FROM import_framework_fingerprint f USING import_framework_fingerprint_tmp t '
+                   'WHERE f.instance_name=%s AND f.table_name=%s AND f.external_id=t.external_id',
+                   (self.instance_name, table))
+        cr.execute("INSERT INTO import_framework_fingerprint "
+                   "(instance_name, table_name, external_id, fingerprint, "
+                   "create_uid, create_date, write_uid, write_date) "
+                   "SELECT %s, %s, external_id, fingerprint, "
+                   "%s, now() at time zone 'UTC', %s, now() at time zone 'UTC' "
+                   "FROM import_framework_fingerprint_tmp",
+                   (self.instance_name, table, uid, uid))
+        cr.execute('DROP TABLE import_framework_fingerprint_tmp')
+        _logger.info('delta: %s fingerprints of table %s saved' % (len(fingerprints), table))
+
+    def clear(self):
+        self.cr.execute('DELETE FROM import_framework_fingerprint WHERE instance_name=%s', (self.instance_name,))
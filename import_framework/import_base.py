@@ -1,13 +1,27 @@
 # -*- coding: utf-8 -*-
 import mapper
+from index import xmlid_index, email_index, lookup_cache
+from bulk_load import bulk_loader
+from profiler import import_profiler
+import delta as delta_mode
+from staging import staging_area
 try:
-    from pandas import DataFrame
+    from pandas import DataFrame, Series
 except ImportError:
     pass
+import copy
+from collections import OrderedDict
+import itertools
+import time
+import threading
 import logging
 _logger = logging.getLogger(__name__)
 
 
+class import_cancelled(Exception):
+    pass
+
+
 class create_childs(object):
     def __init__(self, childs):
 
@@ -31,6 +45,101 @@ class create_childs(object):
     def get_childs(self):
         return self.childs
 
+class row_builder(object):
+    """
+        Preprocessed mapping of a model compiled to a fixed column order.
+
+        build() converts a hooked record to a list of tuples:
+        one for the record itself and one per child of create_childs
+        fields (see _fields_mapp)
+    """
+    def __init__(self, mfields):
+        self.fields = mfields.keys()
+        self.width = len(self.fields)
+        self.mappers = []
+        self.childs = []
+        for pos, key in enumerate(self.fields):
+            val = mfields[key]
+            if isinstance(val, list):
+                self.childs.append((pos, val))
+            else:
+                self.mappers.append((pos, val))
+        self.child_count = max([len(val) for pos, val in self.childs] or [0])
+        # child line is ignored if it has external ids only
+        self.child_check = [pos for pos, val in self.childs
+                            if not self.fields[pos].endswith('/id')]
+        # fast path: positions of mappers are 0..width-1
+        self.simple = not self.childs
+
+    def build(self, dict_sugar):
+        if self.simple:
+            row = tuple([m(dict_sugar) for pos, m in self.mappers])
+            if any(row):
+                return [row]
+            return []
+
+        row = [''] * self.width
+        for pos, m in self.mappers:
+            row[pos] = m(dict_sugar)
+        if not any(row):
+            return []
+        res = [tuple(row)]
+        for i in xrange(self.child_count):
+            row = [''] * self.width
+            for pos, mappers in self.childs:
+                if len(mappers) > i:
+                    row[pos] = mappers[i](dict_sugar)
+            if not any(row):
+                break
+            if any(row[pos] for pos in self.child_check):
+                res.append(tuple(row))
+        return res
+
+
+class adaptive_split(object):
+    """
+        Value of 'split' option of a model mapping for batches of variable size.
+
+        Use : 'split': adaptive_split(seconds=60, start=1000)
+
+        After each batch the size is scaled so that the next batch takes
+        about `seconds` to map and import and its csv data are not
+        bigger than `max_bytes`. The size changes at most `max_factor` times
+        per batch and stays in [min_rows, max_rows].
+    """
+    def __init__(self, seconds=60, start=1000, min_rows=10, max_rows=100000,
+                 max_bytes=50*1024*1024, max_factor=2.0):
+        self.seconds = seconds
+        self.rows = start
+        self.min_rows = min_rows
+        self.max_rows = max_rows
+        self.max_bytes = max_bytes
+        self.max_factor = max_factor
+
+    def __int__(self):
+        return self.rows
+
+    def update(self, rows, seconds, size):
+        """
+            @param rows: rows in the last batch
+            @param seconds: time of the last batch
+            @param size: bytes of csv data of the last batch
+        """
+        if not rows:
+            return
+        if seconds > 0:
+            new = rows * float(self.seconds) / seconds
+        else:
+            new = self.rows * self.max_factor
+        if size and self.max_bytes:
+            new = min(new, rows * float(self.max_bytes) / size)
+        new = max(self.rows / self.max_factor, min(self.rows * self.max_factor, new))
+        new = int(max(self.min_rows, min(self.max_rows, new)))
+        if new != self.rows:
+            _logger.info('split: %s rows in %.1fs (%s bytes), next batches have %s rows' % (rows, seconds, size, new))
+        self.rows = new
+
+
 class import_base(object):
 
     def __init__(self, pool, cr, uid,
@@ -39,7 +148,16 @@ class import_base(object):
                  email_to_notify=False,
                  import_dir = '/tmp/', # path to save *.csv files for debug or manual upload
                  run_import = True,
-                 context=None):
+                 context=None,
+                 chunk_size=10000, # max rows per base_import.import record
+                 vectorize=False, # default for 'vectorize' option of models
+                 workers=1, # number of tables to import in parallel
+                 resume=False, # skip batches imported by previous run, see map_and_import
+                 profile=False, # collect statistics and save report to import_dir, see profiler
+                 delta=False, # import only new and changed rows, see filter_unchanged
+                 staging='csv', # format of batches saved to import_dir: 'csv' or 'parquet', see staging
+                 replay=False, # import batches saved to import_dir by previous run, see replay_staged
+                 ):
         #Thread.__init__(self)
         self.import_options = {'quoting':'"', 'separator':',', 'headers':True}
         self.external_id_field = 'id'
@@ -56,6 +174,27 @@ class import_base(object):
         self.import_dir = import_dir
         self.run_import = run_import
         self.import_num = 1
+        self.import_counter = itertools.count(1)
+        self.chunk_size = chunk_size
+        self.vectorize = vectorize
+        self.workers = workers
+        self.resume = resume
+        self.delta = delta
+        self.replay = replay
+        self.staging = import_dir and staging_area(import_dir, instance_name, staging) or None
+        self.current_model = None # (table, model_num) in progress
+        self.table_columns = None # external fields used by the table in progress, see get_table_columns
+        self.job_id = None # import_framework.job to report progress, see report_progress
+        self.job_rows = 0
+        self.job_started = time.time()
+        self.tables_counter = itertools.count(1)
+        self.xmlid_index = xmlid_index()
+        self.email_index = email_index()
+        self.lookup_cache = lookup_cache()
+        self.profiler = profile and import_profiler(instance_name) or None
+        self.profile_stats = None
+        self.row_builders = {}
+        self.batch_bytes = 0
         self.initialize()
 
 
@@ -72,6 +211,22 @@ class import_base(object):
         """
         pass
 
+    def init_worker(self):
+        """
+            call in the worker copy of the instance (see clone)
+            before it imports anything.
+            Use to open new connections to the external database,
+            because they are usually not thread-safe
+        """
+        pass
+
+    def cleanup(self):
+        """
+            call by import_framework.job when the job is finished
+            (successfully or not), e.g. to remove temporary files
+        """
+        pass
+
     def init_run(self):
         """
             call after intialize run in the thread, not in the main process
@@ -113,6 +268,21 @@ class import_base(object):
                 'dependencies' : [TABLE_1, TABLE_2],
                 #Not required
                 'hook' : self.function_name, #get the val dict of the object, return the same val dict or False
+                'prepare' : self.function_name, # called with DataFrame of the batch before hook, to resolve what hook needs with a few queries, see resolve_xml_ids
+                #Not required
+                'vectorize': True or False, # map column by column via mapper.vectorize, see map_frame
+                #Not required
+                'bulk_load': True or False, # write rows with COPY instead of base_import, see bulk_load.bulk_loader
+                #Not required
+                'split': 1000 or adaptive_split(seconds=60), # import table by batches of rows (one commit per batch)
+                #Not required
+                'columns': ['field1', ..], # external fields used by hooks in addition to ones known from mapping, see get_table_columns
+                #Not required
+                'stream': True or False, # 'table' returns iterator of DataFrame chunks instead of DataFrame, see iter_batches
+                #Not required
+                'delta': True or False, # False to import all rows even in delta mode, by default => True. Streamed tables are filtered by chunks, rows of an external id must be consecutive
+                #Not required
+                'external_id': 'id', # column with external id of the row for delta mode, by default => self.external_id_field
                 'map' : { @see mapper
                     'openerp_field_name' : 'external_field_name', or val('external_field_name')
                     'openerp_field_id/id' : ref(TABLE_1, 'external_id_field'), #make the mapping between the external id and the xml on the right
@@ -143,6 +313,7 @@ class import_base(object):
         # for debug
         return None
     def get_hook_ignore_empty(self, *args):
+        @mapper.uses(*args)
         def f(external_values):
             ignore = True
             for key in args:
@@ -162,13 +333,57 @@ class import_base(object):
             res[m['name']] = m
         return res
 
+    def mark_indexes(self):
+        """
+            start watermarks of self.cr in shared indexes, see xmlid_index.mark
+        """
+        self.xmlid_index.mark(self.cr)
+        self.email_index.mark(self.cr)
+
     def run(self):
         self.mapped = set()
+        self.job_started = time.time()
+        self.mark_indexes()
         self.mapping = self.prepare_mapping(self.get_mapping())
-        self.resolve_dependencies([k for k in self.mapping])
+        if self.replay:
+            self.replay_staged()
+        else:
+            if self.resume:
+                # ids of imported records are loaded from ir_model_data,
+                # so xmlid_index doesn't need anything from previous run
+                _logger.info('resume previous run of %s' % self.instance_name)
+                if self.staging:
+                    self.import_counter = itertools.count(self.staging.last_num() + 1)
+            else:
+                self.clear_checkpoints()
+                if self.staging:
+                    self.staging.clear()
+            if self.workers > 1:
+                self.resolve_dependencies_parallel([k for k in self.mapping])
+            else:
+                self.resolve_dependencies([k for k in self.mapping])
         _logger.info('finalize...')
         self.finalize()
         _logger.info('finalize done')
+        if self.profiler:
+            files = self.profiler.save('%s/profile-%s-%s' % (
+                self.import_dir or '/tmp',
+                self.instance_name,
+                time.strftime('%Y%m%d-%H%M%S')))
+            _logger.info('profile report: %s' % files)
+        stats = self.xmlid_index.stats()
+        _logger.info('xmlid_index: %(records)s records of %(modules)s modules, '
+                     'hit rate %(hit_rate).2f (%(hits)s hits, %(misses)s misses), '
+                     'memory %(memory)s bytes' % stats)
+        if self.email_index.emails is not None:
+            stats = self.email_index.stats()
+            _logger.info('email_index: %(emails)s emails, %(aliases)s aliases, '
+                         'hit rate %(hit_rate).2f (%(hits)s hits, %(misses)s misses), '
+                         'memory %(memory)s bytes' % stats)
+        if self.lookup_cache.caches:
+            stats = self.lookup_cache.stats()
+            _logger.info('lookup_cache: %(values)s values of %(lookups)s lookups, '
+                         'hit rate %(hit_rate).2f (%(hits)s hits, %(misses)s misses)' % stats)
 
     def _fix_size_limit(self):
         import sys
@@ -193,9 +408,12 @@ class import_base(object):
         import_obj = self.pool['base_import.import']
         for imp in import_list:
             try:
+                start = time.time()
                 messages = import_obj.do(self.cr, self.uid,
                                          imp.get('id'), imp.get('fields'),
                                          self.import_options, context=context)
+                if self.profile_stats:
+                    self.profile_stats['base_import_time'] += time.time() - start
                 _logger.info('import_result:\n%s'%messages)
             except Exception as e:
 
@@ -210,6 +428,7 @@ class import_base(object):
 
                 raise Exception(error)
             self.cr.commit()
+            self.xmlid_index.refresh(self.cr)
 
     def resolve_dependencies(self, deps):
         import_list = []
@@ -224,86 +443,634 @@ class import_base(object):
             self.resolve_dependencies(mtable.get('dependencies', []))
             self.map_and_import(mtable)
 
+    def clone(self):
+        """
+            @return: copy of the instance with its own cursor and mapping
+                     (hooks and mappers are bound to the copy)
+        """
+        worker = copy.copy(self)
+        worker.cr = self.pool.cursor()
+        worker.mark_indexes()
+        worker.row_builders = {}
+        worker.init_worker()
+        worker.mapping = worker.prepare_mapping(worker.get_mapping())
+        return worker
+
+    def resolve_dependencies_parallel(self, deps):
+        """
+            Same as resolve_dependencies, but independent tables are
+            imported in parallel by self.workers threads. Each thread
+            uses its own copy of the instance (see clone) and commits
+            every table separately. A table is started only after all
+            its dependencies are imported.
+        """
+        from openerp import api
+
+        # collect dependencies graph in the same order as resolve_dependencies
+        order = []
+        graph = {}
+        def collect(names):
+            for dname in names:
+                if dname in graph:
+                    continue
+                mtable = self.mapping.get(dname)
+                if not mtable:
+                    _logger.error('no mapping found for %s' % dname)
+                    graph[dname] = None
+                    continue
+                graph[dname] = mtable.get('dependencies', [])
+                collect(graph[dname])
+                order.append(dname)
+        collect(deps)
+        self.mapped.update(graph)
+
+        done = set(dname for dname, d in graph.items() if d is None)
+        pending = list(order)
+        running = set()
+        errors = []
+        cancelled = []
+        cond = threading.Condition()
+
+        def next_table():
+            with cond:
+                while True:
+                    if errors or not pending:
+                        return None
+                    for dname in pending:
+                        if all(d in done for d in graph[dname] if d in graph):
+                            pending.remove(dname)
+                            running.add(dname)
+                            return dname
+                    if not running:
+                        errors.append('dependency cycle between tables: %s' % pending)
+                        cond.notify_all()
+                        return None
+                    cond.wait()
+
+        def work(worker):
+            with api.Environment.manage():
+                try:
+                    while True:
+                        dname = next_table()
+                        if not dname:
+                            break
+                        try:
+                            worker.map_and_import(worker.mapping[dname])
+                            worker.cr.commit()
+                        except import_cancelled as e:
+                            worker.cr.rollback()
+                            with cond:
+                                cancelled.append(e)
+                                errors.append('table %s: %s' % (dname, e))
+                        except Exception as e:
+                            _logger.exception('error on importing table %s' % dname)
+                            worker.cr.rollback()
+                            with cond:
+                                errors.append('table %s: %s' % (dname, e))
+                        with cond:
+                            running.discard(dname)
+                            done.add(dname)
+                            cond.notify_all()
+                finally:
+                    worker.xmlid_index.forget(worker.cr)
+                    worker.email_index.forget(worker.cr)
+                    worker.cr.close()
+
+        threads = []
+        for i in range(min(self.workers, len(pending)) or 1):
+            t = threading.Thread(target=work, args=(self.clone(),),
+                                 name='%s-import-%s' % (self.instance_name, i))
+            t.dbname = self.cr.dbname
+            threads.append(t)
+            t.start()
+        for t in threads:
+            t.join()
+        if cancelled:
+            raise cancelled[0]
+        if errors:
+            raise Exception('\n'.join(errors))
+
     def map_and_import(self, mtable):
-        _logger.info('read table %s' % mtable.get('name'))
-        records = mtable.get('table')()
+        name = mtable.get('name')
+        models = mtable.get('models')
+        checkpoints = {}
+        if self.resume:
+            checkpoints = self.get_checkpoints(name)
+            if all(checkpoints.get(model_num, {}).get('batch') == -1 for model_num in range(len(models))):
+                _logger.info('table %s is already imported' % name)
+                return
 
-        for mmodel in mtable.get('models'):
-            split = mmodel.get('split')
-            if not split:
-                _logger.info('map and import: import-%s' % self.import_num)
-                self.map_and_import_batch(mmodel, records)
+        self.table_columns = self.get_table_columns(mtable)
+        if self.table_columns is not None:
+            _logger.info('table %s uses %s fields' % (name, len(self.table_columns)))
+        stream = mtable.get('stream')
+        records = None
+        if stream:
+            # table is read by chunks for each model, see iter_batches
+            _logger.info('stream table %s' % name)
+        else:
+            _logger.info('read table %s' % name)
+            start = time.time()
+            records = mtable.get('table')()
+            if self.profiler:
+                self.profiler.table_stats(name)['read_time'] += time.time() - start
+        total = records is not None and len(records) or 0
+
+        fingerprints = None
+        chunk_filter = None
+        unchanged = False
+        if self.delta and mtable.get('delta', True):
+            stored = delta_mode.fingerprint_store(self.cr, self.instance_name).load(name)
+            if stream:
+                # fingerprints of chunks are collected while models read the table
+                fingerprints = OrderedDict()
+                def chunk_filter(chunk):
+                    chunk, res = self.filter_unchanged(name, mtable, chunk, stored)
+                    if res:
+                        fingerprints.update(res)
+                    return chunk
             else:
-                i=0
-                while True:
-                    _logger.info('importing batch # %s (import-%s)' % (i,self.import_num))
-                    rr = records[i*split:(i+1)*split]
-                    if len(rr):
-                        self.map_and_import_batch(mmodel, rr)
-                        i += 1
-                    else:
-                        break
+                records, fingerprints = self.filter_unchanged(name, mtable, records, stored)
+                if fingerprints is not None and not fingerprints:
+                    _logger.info('table %s has no changes, only finalize of its models is run' % name)
+                    unchanged = True
+
+        for model_num, mmodel in enumerate(models):
+            self.current_model = (name, model_num)
+            if self.profiler:
+                self.profile_stats = self.profiler.model_stats(name, model_num, mmodel.get('model'))
+            batch = 0
+            offset = 0
+            checkpoint = checkpoints.get(model_num)
+            if checkpoint:
+                if checkpoint['batch'] == -1:
+                    _logger.info('model %s of table %s is already imported' % (mmodel.get('model'), name))
+                    continue
+                batch = checkpoint['batch'] + 1
+                offset = checkpoint['rows_done']
+                _logger.info('resume model %s of table %s from batch # %s (row %s)' % (mmodel.get('model'), name, batch, offset))
+
+            split = mmodel.get('split')
+            batches = not unchanged and self.iter_batches(mtable, mmodel, records, offset, chunk_filter) or []
+            for rr in batches:
+                if split or stream:
+                    _logger.info('importing batch # %s (import-%s)' % (batch, self.import_num))
+                else:
+                    _logger.info('map and import: import-%s' % self.import_num)
+                self.batch_bytes = 0
+                start = time.time()
+                self.map_and_import_batch(mmodel, rr)
+                if isinstance(split, adaptive_split):
+                    split.update(len(rr), time.time() - start, self.batch_bytes)
+                offset += len(rr)
+                self.save_checkpoint(name, model_num, mmodel, batch, offset)
+                self.job_rows += len(rr)
+                self.report_progress(name, mmodel, batch, offset, total)
+                batch += 1
+
             finalize = mmodel.get('finalize')
             if finalize:
                 _logger.info('finalize model...')
                 finalize()
                 _logger.info('finalize model done')
+                if self.staging:
+                    self.staging.save_finalize(name, model_num)
+            self.save_checkpoint(name, model_num, mmodel, -1, offset)
+        self.profile_stats = None
+        self.report_progress(name, None, -1, total, total, tables_done=next(self.tables_counter))
+        if fingerprints and self.run_import:
+            # rows are only staged without run_import, they must not be skipped by next run
+            delta_mode.fingerprint_store(self.cr, self.instance_name).save(name, fingerprints, self.uid)
+            self.cr.commit()
+
+    def get_table_columns(self, mtable):
+        """
+            External fields used by mapping of the table:
+            fields of mappers (see mapper.columns), hooks and functions
+            declared with mapper.uses, 'columns' lists of the table and its models.
+
+            get_data may read these fields only (plus keys it needs to join tables).
+            @return: set of fields or None if some mapper or hook doesn't declare them
+        """
+        res = set(mtable.get('columns', []))
+        for mmodel in mtable.get('models', []):
+            res |= set(mmodel.get('columns', []))
+            specs = []
+            if mmodel.get('hook'):
+                specs.append(mmodel.get('hook'))
+            for val in mmodel.get('fields', {}).values():
+                if isinstance(val, create_childs):
+                    for child in val.get_childs():
+                        specs.extend(child.values())
+                else:
+                    specs.append(val)
+            for spec in specs:
+                columns = mapper.columns_of(spec)
+                if columns is None:
+                    return None
+                res |= columns
+        return res
+
+    def iter_batches(self, mtable, mmodel, records, offset, chunk_filter=None):
+        """
+            Yield parts of the table for map_and_import_batch,
+            starting from row `offset`.
+            mmodel['split'] rows per part if set, otherwise the whole table.
+
+            Streamed table (see 'stream' option) is read again for each model,
+            every its chunk is a separate part (split further if 'split' is set),
+            so the table is never loaded at once.
+            In delta mode chunks are passed through chunk_filter, rows of
+            an external id are moved to one chunk (see delta.align_chunks).
+        """
+        split = mmodel.get('split')
+        if records is None:
+            chunks = mtable.get('table')()
+            if chunk_filter:
+                external_id = mtable.get('external_id', self.external_id_field)
+                chunks = (chunk_filter(c) for c in delta_mode.align_chunks(chunks, external_id))
+        else:
+            chunks = [records]
+        pos = 0
+        for chunk in chunks:
+            size = len(chunk)
+            if pos + size <= offset:
+                pos += size
+                continue
+            if offset > pos:
+                chunk = chunk[offset - pos:]
+            pos += size
+            if not split:
+                yield chunk
+                continue
+            start = 0
+            while start < len(chunk):
+                rr = chunk[start:start+int(split)]
+                start += len(rr)
+                yield rr
+
+    def filter_unchanged(self, table, mtable, records, stored=None):
+        """
+            Delta mode: skip rows that were imported by previous runs
+            and have the same fingerprint now. All rows of an external id
+            are skipped or imported together, see delta.compute_fingerprints.
+            Fingerprints of the rest are saved after the table is imported
+            (see map_and_import).
+
+            @param stored: fingerprints saved by previous runs, loaded if not set
+            @return: (records to import, list of (external id, fingerprint) of them)
+                     fingerprints is None if rows have no external ids
+        """
+        external_id = mtable.get('external_id', self.external_id_field)
+        fingerprints = delta_mode.compute_fingerprints(records, external_id)
+        if fingerprints is None:
+            _logger.info('delta: table %s has rows without "%s", all rows are imported' % (table, external_id))
+            return records, None
+
+        ids, fingerprints = fingerprints
+        if stored is None:
+            stored = delta_mode.fingerprint_store(self.cr, self.instance_name).load(table)
+        changed = set(id for id, fingerprint in fingerprints.items() if stored.get(id) != fingerprint)
+        keep = [id in changed for id in ids]
+        if isinstance(records, DataFrame):
+            records = records[keep].reset_index(drop=True)
+        else:
+            records = [r for r, k in zip(records, keep) if k]
+        fingerprints = [(id, fingerprint) for id, fingerprint in fingerprints.items() if id in changed]
+        _logger.info('delta: table %s has %s new or changed rows of %s' % (table, sum(keep), len(keep)))
+        return records, fingerprints
+
+    def report_progress(self, table, mmodel, batch, rows_done, rows_total, **vals):
+        """
+            Update import_framework.job if the import runs as a job.
+            Called after each batch and after each table (batch=-1).
+            @raise import_cancelled: if the job is cancelled
+        """
+        if not self.job_id:
+            return
+        elapsed = time.time() - self.job_started
+        vals.update({'table_name': table,
+                     'model': mmodel and mmodel.get('model') or False,
+                     'batch': batch,
+                     'rows_done': rows_done,
+                     'rows_total': rows_total,
+                     'rows_per_sec': elapsed and self.job_rows / elapsed or 0.0,
+                     })
+        self.pool['import_framework.job'].report_progress(self.cr, self.uid, self.job_id, vals)
+
+    def get_checkpoints(self, table):
+        """
+            @return: {model_num: checkpoint of the model} for the table
+        """
+        checkpoint_obj = self.pool['import_framework.checkpoint']
+        ids = checkpoint_obj.search(self.cr, self.uid, [('instance_name', '=', self.instance_name),
+                                                        ('table_name', '=', table)])
+        res = {}
+        for r in checkpoint_obj.read(self.cr, self.uid, ids, ['model_num', 'batch', 'rows_done']):
+            res[r['model_num']] = r
+        return res
+
+    def save_checkpoint(self, table, model_num, mmodel, batch, rows_done):
+        """
+            mark split batch as imported, batch=-1 means that model is finalized
+
+            There is one checkpoint per model of the table, it's updated by each batch.
+            Nothing is saved without run_import: rows are only staged.
+        """
+        if not self.run_import:
+            return
+        checkpoint_obj = self.pool['import_framework.checkpoint']
+        ids = checkpoint_obj.search(self.cr, self.uid, [('instance_name', '=', self.instance_name),
+                                                        ('table_name', '=', table),
+                                                        ('model_num', '=', model_num)])
+        vals = {
+            'model': mmodel.get('model'),
+            'batch': batch,
+            'rows_done': rows_done,
+        }
+        if ids:
+            checkpoint_obj.write(self.cr, self.uid, ids, vals)
+        else:
+            vals.update({
+                'instance_name': self.instance_name,
+                'table_name': table,
+                'model_num': model_num,
+            })
+            checkpoint_obj.create(self.cr, self.uid, vals)
+        self.cr.commit()
+
+    def clear_checkpoints(self):
+        checkpoint_obj = self.pool['import_framework.checkpoint']
+        ids = checkpoint_obj.search(self.cr, self.uid, [('instance_name', '=', self.instance_name)])
+        checkpoint_obj.unlink(self.cr, self.uid, ids)
+        self.cr.commit()
 
     def map_and_import_batch(self, mmodel, records):
-            import_list = self.do_mapping(records, mmodel)
             context = mmodel.get('context')
             if context:
                 context = context()
-            self.do_import(import_list, context)
+            if self.profile_stats:
+                self.profile_stats['rows_read'] += len(records)
+            prepare = mmodel.get('prepare')
+            if prepare:
+                start = time.time()
+                prepare(records)
+                if self.profile_stats:
+                    self.profile_stats['hook_time'] += time.time() - start
+            for imp in self.iter_mapping(records, mmodel):
+                self.do_import([imp], context)
+            self.after_batch(mmodel)
+
+    def after_batch(self, mmodel):
+        """
+            update caches after records of the model are imported
+        """
+        self.lookup_cache.invalidate(mmodel.get('model'))
+        if mmodel.get('model') in ('res.partner', 'res.users'):
+            self.email_index.refresh(self.cr)
+
+    def replay_staged(self):
+        """
+            Import batches saved to import_dir by previous run
+            (see staging.staging_area) in the same order,
+            without reading the source and mapping.
+
+            Finalize functions of the models are called again.
+            Changes done by hooks directly in database are not replayed.
+        """
+        if not self.staging:
+            raise Exception('replay: import_dir is not set')
+        entries = self.staging.entries()
+        _logger.info('replay %s batches from %s' % (len([e for e in entries if not e.get('finalize')]),
+                                                    self.staging.manifest))
+        for entry in entries:
+            mmodel = self.mapping[entry['table']]['models'][entry['model_num']]
+            if entry.get('finalize'):
+                _logger.info('finalize model...')
+                mmodel.get('finalize')()
+                _logger.info('finalize model done')
+                continue
+            context = mmodel.get('context')
+            if context:
+                context = context()
+            _logger.info('replay %s' % entry['file'])
+            frame, data_binary = self.staging.load(entry, self.import_options, frame=bool(mmodel.get('bulk_load')))
+            imp = self._import_chunk(mmodel, entry['fields'], frame, data_binary)
+            if imp:
+                self.do_import([imp], context)
+            self.after_batch(mmodel)
 
     def do_mapping(self, records, mmodel):
+        return list(self.iter_mapping(records, mmodel))
 
-        hook = mmodel.get('hook', self.default_hook)
+    def iter_mapping(self, records, mmodel):
+        """
+            Map records and yield base_import.import references
+            one by one, each of them contains at most
+            mmodel['chunk'] (or self.chunk_size) rows.
 
-        res = []
+            Mapped rows are never accumulated for the whole table,
+            so memory usage doesn't depend on table size.
+        """
+        chunk_size = mmodel.get('chunk') or self.chunk_size
+        if mmodel.get('vectorize', self.vectorize):
+            mfields = self.get_mapping_fields(mmodel)
+            if not any(isinstance(val, list) for val in mfields.values()):
+                return self._iter_mapping_vectorized(records, mmodel, mfields, chunk_size)
+            _logger.info('vectorize mode is not supported for create_childs, map row by row')
+        return self._iter_mapping_rows(records, mmodel, chunk_size)
 
+    def _iter_mapping_rows(self, records, mmodel, chunk_size):
+        fields = None
+        chunk = []
+        empty = True
+        for fields, values_list in self.iter_mapped_rows(records, mmodel):
+            chunk.extend(values_list)
+            if len(chunk) >= chunk_size:
+                empty = False
+                imp = self._chunk_to_import(mmodel, fields, chunk)
+                chunk = []
+                if imp:
+                    yield imp
+        if chunk:
+            empty = False
+            imp = self._chunk_to_import(mmodel, fields, chunk)
+            if imp:
+                yield imp
+        if empty:
+            _logger.info("no records to import")
+
+    def get_mapping_fields(self, mmodel):
+        """
+            @return: preprocessed mapping of the model fields
+                     (wrapped with timers if profiling is enabled)
+        """
         mfields = self._preprocess_mapping(mmodel.get('fields'))
+        if self.profile_stats:
+            mfields = self.profiler.wrap_fields(self.profile_stats, mfields)
+        return mfields
+
+    def get_row_builder(self, mmodel):
+        """
+            @return: row_builder of the model, compiled once per model
+        """
+        builder = self.row_builders.get(id(mmodel))
+        if not builder:
+            builder = row_builder(self.get_mapping_fields(mmodel))
+            self.row_builders[id(mmodel)] = builder
+        return builder
+
+    def iter_mapped_rows(self, records, mmodel):
+        """
+            @return: generator of (fields, values_list) per hooked record
+        """
+        hook = mmodel.get('hook', self.default_hook)
+        builder = self.get_row_builder(mmodel)
+        fields = builder.fields
+        stats = self.profile_stats
         _logger.info('mapping records to %s: %s' %( mmodel.get('model'), len(records)))
         for key, r in records.iterrows():
+            if stats:
+                start = time.time()
             hooked = hook(dict(r))
             if not isinstance(hooked, list):
                 hooked = [hooked]
+            if stats:
+                stats['hook_time'] += time.time() - start
 
             for dict_sugar in hooked:
                 if dict_sugar:
-                    fields, values_list = self._fields_mapp(dict_sugar, mfields)
-                    res.extend(values_list)
+                    if stats:
+                        stats['rows_hooked'] += 1
+                    values_list = builder.build(dict_sugar)
+                    if values_list:
+                        yield fields, values_list
 
-        if not res:
+    def _iter_mapping_vectorized(self, records, mmodel, mfields, chunk_size):
+        _logger.info('mapping records to %s (vectorize): %s' %( mmodel.get('model'), len(records)))
+        fields = mfields.keys()
+        empty = True
+        for start in xrange(0, len(records), chunk_size):
+            res = self.map_frame(records[start:start+chunk_size], mmodel, mfields)
+            if len(res):
+                empty = False
+                imp = self._chunk_to_import(mmodel, fields, res)
+                if imp:
+                    yield imp
+        if empty:
             _logger.info("no records to import")
-            return []
-        res = DataFrame(res)
+
+    def map_frame(self, records, mmodel, mfields):
+        """
+            Vectorize mode of mapping.
+
+            Hook (if any) is still applied row by row, but then every field
+            is computed for the whole column at once via mapper.vectorize.
+            Mappers without vectorize support (call, lambda, dbmapper, etc.)
+            are applied row by row.
+
+            @return: DataFrame with a column per field
+        """
+        stats = self.profile_stats
+        hook = mmodel.get('hook')
+        if hook is None and self.default_hook.im_func is not import_base.default_hook.im_func:
+            hook = self.default_hook
+        if hook:
+            start = time.time()
+            hooked = []
+            keys = set()
+            for i, r in records.iterrows():
+                res = hook(dict(r))
+                if not isinstance(res, list):
+                    res = [res]
+                for dict_sugar in res:
+                    if dict_sugar:
+                        hooked.append(dict_sugar)
+                        keys.update(dict_sugar)
+            if stats:
+                stats['hook_time'] += time.time() - start
+            rows = []
+            for dict_sugar in hooked:
+                # missed keys must be None (as dict.get returns), not NaN
+                row = dict.fromkeys(keys)
+                row.update(dict_sugar)
+                rows.append(row)
+            records = DataFrame(rows, columns=list(keys), dtype=object)
+
+        if stats:
+            stats['rows_hooked'] += len(records)
+
+        fields = mfields.keys()
+        if not len(records):
+            return DataFrame(columns=fields)
+
+        rows = None
+        columns = {}
+        for key in fields:
+            val = mfields[key]
+            col = None
+            if isinstance(val, mapper.mapper):
+                col = val.vectorize(records)
+            if col is None:
+                if rows is None:
+                    rows = [dict(r) for i, r in records.iterrows()]
+                col = Series([val(r) for r in rows], index=records.index, dtype=object)
+            columns[key] = col
+        res = DataFrame(columns, columns=fields)
+
+        # ignore empty lines
+        return res[mapper.truth(res).any(axis=1)]
+
+    def _chunk_to_import(self, mmodel, fields, rows):
+        _logger.info('chunk of %s rows to %s' % (len(rows), mmodel.get('model')))
+        stats = self.profile_stats
+        start = time.time()
+        if isinstance(rows, DataFrame):
+            res = rows
+        else:
+            res = DataFrame(rows)
         data_binary = res.to_csv(sep=self.import_options.get('separator'),
                                  quotechar=self.import_options.get('quoting'),
                                  index=False,
                                  header = fields,
                                  encoding='utf-8'
                                  )
+        self.batch_bytes += len(data_binary)
+        if stats:
+            stats['to_csv_time'] += time.time() - start
+            stats['chunks'] += 1
 
-        if self.import_dir:
-            file_name = '%s/import-%03d-%s.csv' % (
-                self.import_dir,
-                self.import_num,
-                mmodel.get('model'),
-                )
-            with open(file_name, 'w') as f:
-                f.write(data_binary)
-
-            self.import_num += 1
+        if self.staging:
+            # counter is shared with worker copies, see clone
+            import_num = next(self.import_counter)
+            table, model_num = self.current_model or (None, None)
+            self.staging.save(import_num, table, model_num, mmodel.get('model'), fields, res, data_binary)
+            self.import_num = import_num + 1
 
         if not self.run_import:
-            return []
-        id = self.pool['base_import.import'].create(self.cr, self.uid,
-            {'res_model':mmodel.get('model'),
-             'file': data_binary,
-             'file_name': mmodel.get('model'),
-             })
-        return [{'id':id, 'fields':fields}]
+            return None
+        return self._import_chunk(mmodel, fields, res, data_binary)
+
+    def _import_chunk(self, mmodel, fields, res, data_binary):
+        """
+            @param res: DataFrame of mapped rows, used for bulk_load only
+            @param data_binary: the rows as csv for base_import
+        """
+        stats = self.profile_stats
+        start = time.time()
+        if mmodel.get('bulk_load'):
+            bulk_loader(self, mmodel.get('model')).load(fields, res.values.tolist())
+            self.cr.commit()
+            id = None
+        else:
+            id = self.pool['base_import.import'].create(self.cr, self.uid,
+                {'res_model':mmodel.get('model'),
+                 'file': data_binary,
+                 'file_name': mmodel.get('model'),
+                 })
+        if stats:
+            stats['base_import_time'] += time.time() - start
+        return id and {'id':id, 'fields':fields}
 
     def _preprocess_mapping(self, mapping):
         """
@@ -343,44 +1110,14 @@ class import_base(object):
 fields =
 ['name', 'child_ids/id', 'child_ids/name']
 res = [
-[name0, '',''], # i=-1
-['', id1, name1] # i=0
-['', id2, name2] # i=1
+(name0, '',''), # i=-1
+('', id1, name1) # i=0
+('', id2, name2) # i=1
 ]
+            Compiles mapping on each call, use get_row_builder for batches
         """
-        res = []
-        i = -1
-        while True:
-            fields=[]
-            data_lst = []
-            for key,val in openerp_dict.items():
-                if key not in fields:
-                    fields.append(key)
-                    if isinstance(val, list) and len(val)>i and i>=0:
-                        value = val[i](dict_sugar)
-                    elif not isinstance(val, list) and i==-1:
-                        value = val(dict_sugar)
-                    else:
-                        value = ''
-                    data_lst.append(value)
-            if any(data_lst):
-                add = True
-                if i>=0:
-                    print '_fields_mapp', zip(fields, data_lst)
-                    add = False
-                    # ignore empty lines
-                    for pos, val in enumerate(data_lst):
-                        if fields[pos].endswith('/id'):
-                            continue
-                        if val:
-                            add = True
-                            break
-                if add:
-                    res.append(data_lst)
-                i += 1
-            else:
-                break
-        return fields, res
+        builder = row_builder(openerp_dict)
+        return builder.fields, builder.build(dict_sugar)
 
     def xml_id_exist(self, table, external_id):
         """
@@ -393,9 +1130,55 @@ res = [
             return False
 
         xml_id = self._generate_xml_id(external_id, table)
-        id = self.pool.get('ir.model.data').search(self.cr, self.uid, [('name', '=', xml_id), ('module', '=', self.module_name)])
+        id = self.xmlid_index.get(self.cr, self.module_name, xml_id)
         return id and xml_id or False
 
+    def name_exist(self, table, name, model):
+        """
+            Find record of the model by name (see refbyname mapper)
+            and make sure it has the xml id generated from the name
+            @return: the xml_id or '' if there is no record with this name
+        """
+        if not name:
+            return ''
+        ids = self.lookup_cache.lookup(self.pool, self.cr, self.uid, model, 'name', name, context=self.context)
+        if not ids:
+            return ''
+        xml_id = self._generate_xml_id(name, table)
+        if not self.xmlid_index.get(self.cr, '', xml_id):
+            self.pool['ir.model.data'].create(self.cr, self.uid, {'name': xml_id,
+                                                                  'model': model,
+                                                                  'module': '',
+                                                                  'res_id': ids[0],
+                                                                  }, context=self.context)
+            self.xmlid_index.set('', xml_id, ids[0])
+        return xml_id
+
+    def xmlid_to_res_id(self, xmlid):
+        """
+            Same as ir.model.data.xmlid_to_res_id, but uses self.xmlid_index
+            @param xmlid: 'module.name' ('.name' for records imported without module)
+        """
+        module, name = xmlid.split('.', 1)
+        return self.xmlid_index.get(self.cr, module, name) or False
+
+    def resolve_xml_ids(self, pairs):
+        """
+            Batch version of res_id mapper for 'prepare' functions
+            @param pairs: iterable of (table, external id)
+            @return: dict (table, external id) -> res_id or False
+        """
+        index = self.xmlid_index
+        xml_ids = {}
+        res = {}
+        for table, external_id in set(pairs):
+            if table not in xml_ids:
+                xml_ids[table] = mapper.xml_id(table)
+                xml_ids[table].set_parent(self)
+            name = xml_ids[table].get_xml_id(external_id)
+            res[(table, external_id)] = name and index.get(self.cr, '', name) or False
+        return res
+
     def _generate_xml_id(self, name, table):
         """
             @param name: name of the object, has to be unique in for a given table
@@ -0,0 +1,410 @@
+# -*- coding: utf-8 -*-
+import sys
+import threading
+from collections import OrderedDict
+import logging
+_logger = logging.getLogger(__name__)
+
+
+def _sizeof_dict(d):
+    size = sys.getsizeof(d)
+    for k, v in d.iteritems():
+        size += sys.getsizeof(k) + sys.getsizeof(v)
+    return size
+
+
+class xmlid_index(object):
+    """
+        In-memory index of ir.model.data: (module, name) -> res_id
+
+        Each module is loaded with one query on first access.
+        After that only new ir_model_data rows are fetched (see refresh),
+        so lookups become dictionary hits.
+
+        Methods take cursor as argument, because the same index is
+        shared by all cursors of the import. Parallel cursors commit
+        ids out of order, so each cursor has its own watermark (see mark).
+    """
+    def __init__(self):
+        self.modules = {}
+        self.watermarks = {} # cursor -> max id of ir_model_data at its mark/refresh
+        self.hits = 0
+        self.misses = 0
+        self.lock = threading.RLock()
+
+    def _load(self, cr, module):
+        with self.lock:
+            if module in self.modules:
+                return self.modules[module]
+            cr.execute('SELECT name, res_id FROM ir_model_data WHERE module=%s', (module,))
+            names = dict(cr.fetchall())
+            self.modules[module] = names
+            _logger.info('xmlid_index: %s records loaded for module "%s"' % (len(names), module))
+            return names
+
+    def get(self, cr, module, name):
+        names = self.modules.get(module)
+        if names is None:
+            names = self._load(cr, module)
+        res_id = names.get(name)
+        if res_id:
+            self.hits += 1
+        else:
+            self.misses += 1
+        return res_id
+
+    def set(self, module, name, res_id):
+        with self.lock:
+            names = self.modules.get(module)
+            if names is not None:
+                names[name] = res_id
+
+    def _max_id(self, cr):
+        cr.execute('SELECT max(id) FROM ir_model_data')
+        return cr.fetchone()[0] or 0
+
+    def mark(self, cr):
+        """
+            remember current max id for the cursor,
+            call before the cursor creates records
+        """
+        with self.lock:
+            self.watermarks[cr] = self._max_id(cr)
+
+    def refresh(self, cr):
+        """
+            fetch ir_model_data rows created since previous mark/refresh
+            of the cursor, call after the cursor commits.
+            Rows of other cursors are fetched by their own refresh.
+            Without mark all rows of loaded modules are read again.
+        """
+        with self.lock:
+            since = self.watermarks.get(cr, 0)
+            self.watermarks[cr] = self._max_id(cr)
+            if not self.modules:
+                return
+            cr.execute('SELECT module, name, res_id FROM ir_model_data WHERE id > %s AND module IN %s',
+                       (since, tuple(self.modules)))
+            for module, name, res_id in cr.fetchall():
+                self.modules[module][name] = res_id
+
+    def forget(self, cr):
+        with self.lock:
+            self.watermarks.pop(cr, None)
+
+    def stats(self):
+        total = self.hits + self.misses
+        return {
+            'modules': len(self.modules),
+            'records': sum(len(names) for names in self.modules.itervalues()),
+            'hits': self.hits,
+            'misses': self.misses,
+            'hit_rate': total and float(self.hits) / total or 0.0,
+            'memory': sum(_sizeof_dict(names) for names in self.modules.itervalues()),
+        }
+
+
+class email_index(object):
+    """
+        In-memory indexes for emails2partners:
+
+        * lower-cased email -> id of active partner
+          (first one in res.partner order, i.e. by display_name)
+        * alias name of active user -> id of user's partner
+
+        Both are loaded with one query each on first use.
+        refresh() resolves again emails and aliases of partners and users
+        written since previous mark/refresh of the cursor, like
+        xmlid_index.refresh, so archived or changed records don't stay.
+    """
+    def __init__(self):
+        self.emails = None
+        self.partner_emails = None # partner id -> its key in emails
+        self.aliases = None
+        self.alias_domain = ''
+        self.watermarks = {} # cursor -> start time of its transaction at mark/refresh
+        self.hits = 0
+        self.misses = 0
+        self.lock = threading.RLock()
+
+    def _now(self, cr):
+        cr.execute("SELECT (now() at time zone 'UTC')")
+        return cr.fetchone()[0]
+
+    def _update(self, cr, since=None):
+        if since is None:
+            self._load_emails(cr)
+            self._load_aliases(cr)
+            return
+
+        # changed partners may be archived or have another email now,
+        # so their old entries are removed and the emails are resolved again
+        cr.execute('SELECT p.id, lower(p.email) FROM res_partner p '
+                   'WHERE p.write_date >= %s', (since,))
+        emails = set()
+        partner_ids = set()
+        for partner_id, email in cr.fetchall():
+            partner_ids.add(partner_id)
+            if email:
+                emails.add(email.strip())
+            if partner_id in self.partner_emails:
+                emails.add(self.partner_emails[partner_id])
+        if emails:
+            self._load_emails(cr, emails)
+
+        cr.execute('SELECT u.partner_id, a.alias_name FROM res_users u '
+                   'LEFT JOIN mail_alias a ON a.id = u.alias_id '
+                   'WHERE u.write_date >= %s', (since,))
+        names = set()
+        for partner_id, alias_name in cr.fetchall():
+            partner_ids.add(partner_id)
+            if alias_name:
+                names.add(alias_name)
+        names.update(name for name, partner_id in self.aliases.iteritems() if partner_id in partner_ids)
+        if names:
+            self._load_aliases(cr, names)
+
+    def _load_emails(self, cr, emails=None):
+        """
+            @param emails: emails to resolve again, all emails by default
+        """
+        where = ''
+        params = ()
+        if emails is not None:
+            for email in emails:
+                partner_id = self.emails.pop(email, None)
+                if partner_id is not None:
+                    self.partner_emails.pop(partner_id, None)
+            where = ' AND lower(trim(p.email)) IN %s'
+            params = (tuple(emails),)
+        cr.execute('SELECT lower(p.email), p.id FROM res_partner p '
+                   'WHERE p.active AND p.email IS NOT NULL' + where +
+                   ' ORDER BY p.display_name, p.id', params)
+        for email, partner_id in cr.fetchall():
+            email = email.strip()
+            if email in self.emails or emails is not None and email not in emails:
+                continue
+            self.emails[email] = partner_id
+            self.partner_emails[partner_id] = email
+
+    def _load_aliases(self, cr, names=None):
+        """
+            @param names: alias names to resolve again, all aliases by default
+        """
+        where = ''
+        params = ()
+        if names is not None:
+            for name in names:
+                self.aliases.pop(name, None)
+            where = ' AND a.alias_name IN %s'
+            params = (tuple(names),)
+        cr.execute('SELECT a.alias_name, u.partner_id FROM res_users u '
+                   'JOIN mail_alias a ON a.id = u.alias_id '
+                   'WHERE u.active AND a.alias_name IS NOT NULL' + where +
+                   ' ORDER BY u.login', params)
+        for alias_name, partner_id in cr.fetchall():
+            if names is not None and alias_name not in names:
+                continue
+            self.aliases.setdefault(alias_name, partner_id)
+
+    def load(self, cr):
+        with self.lock:
+            if self.emails is not None:
+                return
+            self.emails = {}
+            self.partner_emails = {}
+            self.aliases = {}
+            cr.execute("SELECT value FROM ir_config_parameter WHERE key='mail.catchall.domain'")
+            res = cr.fetchone()
+            self.alias_domain = res and res[0] or ''
+            self._update(cr)
+            _logger.info('email_index: %s emails and %s aliases loaded' % (len(self.emails), len(self.aliases)))
+
+    def mark(self, cr):
+        """
+            see xmlid_index.mark. now() is the start of the transaction,
+            so records written by the cursor later have write_date >= it
+        """
+        with self.lock:
+            self.watermarks[cr] = self._now(cr)
+
+    def refresh(self, cr):
+        with self.lock:
+            since = self.watermarks.get(cr)
+            self.watermarks[cr] = self._now(cr)
+            if self.emails is None:
+                return
+            self._update(cr, since)
+
+    def forget(self, cr):
+        with self.lock:
+            self.watermarks.pop(cr, None)
+
+    def find(self, cr, email):
+        """
+            @param email: lower-cased email
+            @return: partner id or None
+        """
+        if self.emails is None:
+            self.load(cr)
+        partner_id = None
+        if self.alias_domain and self.alias_domain == email.split('@')[1]:
+            partner_id = self.aliases.get(email.split('@')[0])
+        if not partner_id:
+            partner_id = self.emails.get(email)
+        if partner_id:
+            self.hits += 1
+        else:
+            self.misses += 1
+        return partner_id
+
+    def stats(self):
+        total = self.hits + self.misses
+        return {
+            'emails': len(self.emails or {}),
+            'aliases': len(self.aliases or {}),
+            'hits': self.hits,
+            'misses': self.misses,
+            'hit_rate': total and float(self.hits) / total or 0.0,
+            'memory': _sizeof_dict(self.emails or {}) + _sizeof_dict(self.aliases or {}),
+        }
+
+
+class lookup_cache(object):
+    """
+        Cache of searches like [(field, '=', value)] for dbmapper:
+        (model, field, value) -> list of ids
+
+        Models with up to prefetch_limit records are read with one query
+        on first lookup. For bigger models each value is searched once.
+        Not found values are cached too.
+        Each (model, field) keeps up to max_size values, least recently used
+        are evicted first.
+
+        Call invalidate(model) after records of the model are created or changed.
+    """
+    def __init__(self, max_size=100000, prefetch_limit=10000):
+        self.max_size = max_size
+        self.prefetch_limit = prefetch_limit
+        self.caches = {}
+        self.complete = set()
+        self.hits = 0
+        self.misses = 0
+        self.lock = threading.RLock()
+
+    def _prefetch(self, pool, cr, uid, model, field, context=None):
+        obj = pool[model]
+        if obj.search(cr, uid, [], context=context, count=True) > self.prefetch_limit:
+            return None
+        ids = obj.search(cr, uid, [], context=context)
+        values = OrderedDict()
+        for record in obj.read(cr, uid, ids, [field], context=context):
+            value = record[field]
+            if isinstance(value, tuple):
+                value = value[0]
+            values.setdefault(value, []).append(record['id'])
+        self.complete.add((model, field))
+        _logger.info('lookup_cache: %s values of %s.%s prefetched' % (len(values), model, field))
+        return values
+
+    def lookup(self, pool, cr, uid, model, field, value, context=None):
+        """
+            @return: ids of model records with field = value, [] if not found
+        """
+        key = (model, field)
+        with self.lock:
+            values = self.caches.get(key)
+            if values is None:
+                values = self._prefetch(pool, cr, uid, model, field, context=context)
+                if values is None:
+                    values = OrderedDict()
+                self.caches[key] = values
+            ids = values.pop(value, None)
+            if ids is not None:
+                self.hits += 1
+                values[value] = ids
+                return ids
+            if key in self.complete:
+                self.hits += 1
+                return []
+            self.misses += 1
+            ids = pool[model].search(cr, uid, [(field, '=', value)], context=context)
+            values[value] = ids
+            if len(values) > self.max_size:
+                values.popitem(last=False)
+            return ids
+
+    def invalidate(self, model=None):
+        with self.lock:
+            for key in self.caches.keys():
+                if model is None or key[0] == model:
+                    del self.caches[key]
+                    self.complete.discard(key)
+
+    def stats(self):
+        total = self.hits + self.misses
+        return {
+            'lookups': len(self.caches),
+            'values': sum(len(values) for values in self.caches.itervalues()),
+            'hits': self.hits,
+            'misses': self.misses,
+            'hit_rate': total and float(self.hits) / total or 0.0,
+        }
+
+
+class frame_cache(object):
+    """
+        LRU cache of DataFrames limited by memory.
+
+        Entries are evicted, least recently used first,
+        when total size (DataFrame.memory_usage) exceeds max_bytes.
+        Frame bigger than max_bytes is not cached.
+        Cached frames are shared, callers must not modify them.
+    """
+    def __init__(self, max_bytes=1024*1024*1024):
+        self.max_bytes = max_bytes
+        self.entries = OrderedDict()
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+        self.lock = threading.RLock()
+
+    def get(self, key):
+        with self.lock:
+            entry = self.entries.pop(key, None)
+            if entry is None:
+                self.misses += 1
+                return None
+            self.entries[key] = entry
+            self.hits += 1
+            return entry[0]
+
+    def set(self, key, frame):
+        size = int(frame.memory_usage(index=True, deep=True).sum())
+        with self.lock:
+            self.discard(key)
+            if size > self.max_bytes:
+                _logger.info('frame_cache: %s is too big to cache (%s bytes)' % (key, size))
+                return
+            self.entries[key] = (frame, size)
+            self.size += size
+            while self.size > self.max_bytes:
+                old_key, (old_frame, old_size) = self.entries.popitem(last=False)
+                self.size -= old_size
+                _logger.info('frame_cache: %s evicted (%s bytes)' % (old_key, old_size))
+
+    def discard(self, key):
+        with self.lock:
+            entry = self.entries.pop(key, None)
+            if entry:
+                self.size -= entry[1]
+
+    def stats(self):
+        total = self.hits + self.misses
+        return {
+            'entries': len(self.entries),
+            'hits': self.hits,
+            'misses': self.misses,
+            'hit_rate': total and float(self.hits) / total or 0.0,
+            'memory': self.size,
+        }
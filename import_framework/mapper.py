@@ -21,6 +21,59 @@
 from openerp import tools
 import re
 import math
+try:
+    from pandas import Series
+except ImportError:
+    pass
+
+
+def column(frame, name, default=None):
+    """
+        @return: column of frame as Series of python objects
+                 or Series of default values if there is no such column
+    """
+    if name in frame:
+        return frame[name].astype(object)
+    return fill(frame, default)
+
+def fill(frame, value):
+    """
+        @return: Series of value with the same index as frame
+    """
+    return Series([value] * len(frame), index=frame.index, dtype=object)
+
+def truth(series):
+    """
+        python truth value of each item, i.e. 'not not v' (NaN is True)
+    """
+    return series.astype(bool)
+
+def uses(*columns):
+    """
+        Use : uses('field1', 'field2')(function)
+        or as decorator of hooks and functions for call
+        declare external fields read by the function itself,
+        see columns_of
+    """
+    def decorator(f):
+        f.columns = set(columns)
+        return f
+    return decorator
+
+def columns_of(spec):
+    """
+        @param spec: value of mapping field, hook or function
+        @return: set of external fields used by spec
+                 or None if it's unknown
+    """
+    if isinstance(spec, mapper):
+        return spec.columns()
+    if isinstance(spec, basestring):
+        return set([spec])
+    columns = getattr(spec, 'columns', None)
+    if columns is not None:
+        return set(columns)
+    return None
 
 class mapper(object):
     """
@@ -35,6 +88,23 @@ class mapper(object):
     def __call__(self, external_values):
         raise NotImplementedError()
 
+    def columns(self):
+        """
+            @return: set of external fields used by the mapper
+                     or None if it's unknown (all fields are needed)
+        """
+        return None
+
+    def vectorize(self, frame):
+        """
+            column-wise version of __call__ used in vectorize mode
+
+            @param frame: DataFrame with external data
+            @return: Series with mapped value for each row of frame
+                     or None if mapper can be applied row by row only
+        """
+        return None
+
 class dbmapper(mapper):
     """
         Super class for mapper that need to access to 
@@ -57,6 +127,14 @@ class dbmapper(mapper):
             return []
         return self.parent.pool['ir.model.data'].browse(self.parent.cr, self.parent.uid, data)
 
+    def lookup(self, model, field, value):
+        """
+            Cached search([(field, '=', value)]), see import_framework.index.lookup_cache
+            @return: list of ids
+        """
+        return self.parent.lookup_cache.lookup(self.parent.pool, self.parent.cr, self.parent.uid,
+                                               model, field, value, context=self.parent.context)
+
 
 class concat(mapper):
     """
@@ -68,14 +146,30 @@ class concat(mapper):
         self.arg = arg
         self.delimiter = delimiter and delimiter.get('delimiter', ' ') or ' '
         
+    def columns(self):
+        return set(self.arg)
+
     def __call__(self, external_values):
         return self.delimiter.join(map(lambda x : tools.ustr(external_values.get(x,'')or ''), self.arg))
 
+    def vectorize(self, frame):
+        res = None
+        for x in self.arg:
+            v = column(frame, x)
+            v = v.where(truth(v), '').map(tools.ustr)
+            res = v if res is None else res + self.delimiter + v
+        if res is None:
+            res = fill(frame, '')
+        return res
+
 class tags_from_fields(dbmapper):
     def __init__(self, table, field_list):
         self.table = table
         self.field_list = field_list
 
+    def columns(self):
+        return set(self.field_list)
+
     def __call__(self, external_values):
         res = []
         for f in self.field_list:
@@ -105,6 +199,9 @@ class ppconcat(mapper):
         if not type(self.skip_value) == str:
             self.skip_value = '^^'
 
+    def columns(self):
+        return set(self.arg)
+
     def __call__(self, external_values):
         return self.delimiter.join(map(lambda x : x + ": " + tools.ustr(external_values.get(x,'')), filter(lambda x: external_values.get(x) and (self.skip_value != external_values.get(x)), self.arg)))
 
@@ -113,6 +210,9 @@ class first(mapper):
         self.arg = arg
         self.lower = kwargs and kwargs.get('lower') or False
 
+    def columns(self):
+        return set(self.arg)
+
     def __call__(self, external_values):
         v = ''
         for a in self.arg:
@@ -123,6 +223,17 @@ class first(mapper):
             v = v.lower()
         return v
 
+    def vectorize(self, frame):
+        res = None
+        for a in reversed(self.arg):
+            v = column(frame, a, '')
+            res = v if res is None else v.where(truth(v), res)
+        if res is None:
+            res = fill(frame, '')
+        if self.lower:
+            res = res.map(lambda v: v and v.lower() or v)
+        return res
+
 class fixdate(mapper):
     """
     convert '2010-02-12 13:26:25' to '2010-02-12'
@@ -130,12 +241,18 @@ class fixdate(mapper):
     def __init__(self, field_name):
         self.field_name = field_name
         
+    def columns(self):
+        return set([self.field_name])
+
     def __call__(self, external_values):
         s = external_values.get(self.field_name)
         if not s:
             return ''
         return str(s).split(' ')[0]
 
+    def vectorize(self, frame):
+        return column(frame, self.field_name).map(lambda s: s and str(s).split(' ')[0] or '')
+
 class const(mapper):
     """
         Use : const(arg)
@@ -144,8 +261,14 @@ class const(mapper):
     def __init__(self, val):
         self.val = val
         
+    def columns(self):
+        return set()
+
     def __call__(self, external_values):
         return self.val 
+
+    def vectorize(self, frame):
+        return fill(frame, self.val)
     
 def do_clean_xml_id(value):
     return re.sub('[\'", ^]','_', (value and unicode(value) or ''))
@@ -166,6 +289,9 @@ class value(mapper):
         self.fallback = fallback
         self.lower = lower
         
+    def columns(self):
+        return set([self.val, self.fallback]) - set([False])
+
     def __call__(self, external_values):
         val = external_values.get(self.val) 
         if self.fallback and not val:
@@ -175,11 +301,23 @@ class value(mapper):
             val = (str(val) or '').lower()
         return val 
 
+    def vectorize(self, frame):
+        val = column(frame, self.val)
+        if self.fallback:
+            val = val.where(truth(val), column(frame, self.fallback))
+        val = val.where(truth(val), self.default)
+        if self.lower:
+            val = val.map(lambda v: (str(v) or '').lower())
+        return val
+
 class mapper_int(mapper):
     def __init__(self, val, default=0):
         self.val = val
         self.default = default
 
+    def columns(self):
+        return set([self.val])
+
     def __call__(self, external_values):
         val = external_values.get(self.val, self.default) 
         return val and int(val) or 0
@@ -192,9 +330,15 @@ class clean_sugar(mapper):
         self.val = val
         self.default = default
 
+    def columns(self):
+        return set([self.val])
+
     def __call__(self, external_values):
         val = external_values.get(self.val, self.default)
         return do_clean_sugar(val)
+
+    def vectorize(self, frame):
+        return column(frame, self.val, self.default).map(do_clean_sugar)
     
     
 class map_val(mapper):
@@ -211,9 +355,15 @@ class map_val(mapper):
         self.map = map
         self.default = default
         
+    def columns(self):
+        return self.val.columns()
+
     def __call__(self, external_values):
         return self.map.get(self.val(external_values), self.default)
 
+    def vectorize(self, frame):
+        return self.val.vectorize(frame).map(lambda v: self.map.get(v, self.default))
+
     
 class ref(dbmapper):
     """
@@ -226,6 +376,9 @@ class ref(dbmapper):
         self.table = table
         self.field_name = field_name
         
+    def columns(self):
+        return set([self.field_name])
+
     def __call__(self, external_values):
         return self.parent.xml_id_exist(self.table, external_values.get(self.field_name))
   
@@ -239,17 +392,25 @@ class refbyname(dbmapper):
         self.field_name = field_name
         self.model = model
         
+    def columns(self):
+        return set([self.field_name])
+
     def __call__(self, external_values):
         v = external_values.get(self.field_name, '')
-        return self.parent.name_exist(self.table, v , self.model)
+        return self.parent.name_exist(self.table, v, self.model)
         
 class xml_id(dbmapper):
     def __init__(self, table, field_name='id'):
         self.table = table
         self.field_name = field_name
         
+    def columns(self):
+        return set([self.field_name])
+
     def __call__(self, external_values):
-        field_value = external_values.get(self.field_name)
+        return self.get_xml_id(external_values.get(self.field_name))
+
+    def get_xml_id(self, field_value):
         if isinstance(field_value, float) and math.isnan(field_value):
             return ''
         field_value = do_clean_xml_id(field_value)
@@ -257,12 +418,18 @@ class xml_id(dbmapper):
             return ''
         return self.parent._generate_xml_id(field_value, self.table)
 
+    def vectorize(self, frame):
+        return column(frame, self.field_name).map(self.get_xml_id)
+
 class user2partner(dbmapper):
     def __init__(self, table_user, field_name='id'):
         self.table_user = table_user
         #self.table_partner = table_partner
         self.field_name = field_name
 
+    def columns(self):
+        return set([self.field_name])
+
     def __call__(self, external_values):
         id = xml_id(self.table_user, self.field_name)
         id.set_parent(self.parent)
@@ -273,11 +440,14 @@ class user_by_login(dbmapper):
     def __init__(self, field_name):
         self.field_name = field_name
 
+    def columns(self):
+        return set([self.field_name])
+
     def __call__(self, external_values):
         login = external_values.get(self.field_name)
         if not login:
             return ''
-        id = self.parent.pool['res.users'].search(self.parent.cr, self.parent.uid, [('login', '=', login)], context=self.parent.context)
+        id = self.lookup('res.users', 'login', login)
         if id:
             return id[0]
         else:
@@ -290,13 +460,15 @@ class country_by_name(dbmapper):
     def __init__(self, field_name):
         self.field_name = field_name
 
+    def columns(self):
+        return set([self.field_name])
+
     def __call__(self, external_values):
         value = external_values.get(self.field_name)
         if not value:
             return ''
         value = FIX_COUNTRY.get(value, value)
-        id = self.parent.pool['res.country'].search(self.parent.cr, self.parent.uid,
-                                                    [('name', '=', value)], context=self.parent.context)
+        id = self.lookup('res.country', 'name', value)
         if id:
             return id[0]
         else:
@@ -308,68 +480,42 @@ class res_id(dbmapper):
         self.field_name = field_name
         self.default = default
 
+    def columns(self):
+        columns = columns_of(self.get_table)
+        return columns is not None and columns | set([self.field_name]) or None
+
     def __call__(self, external_values):
         id = xml_id(self.get_table(external_values), self.field_name)
         id.set_parent(self.parent)
         xmlid = id(external_values)
-        res_id = self.parent.pool['ir.model.data'].xmlid_to_res_id(self.parent.cr,
-                                                                 self.parent.uid,
-                                                                 '.'+xmlid)
+        res_id = self.parent.xmlid_to_res_id('.'+xmlid)
         return res_id and str(res_id) or self.default
 
 
 class emails2partners(dbmapper):
+    """
+        Use : emails2partners(field_name)
+        return comma-separated ids of partners found by emails in the field.
+        Emails in alias domain are resolved to partners of users with that alias.
+
+        Lookups are done in parent.email_index, see import_framework.index
+    """
     def __init__(self, field_name):
         self.field_name = field_name
 
-    def __call__(self, external_values):
-        alias_domain = self.parent.cache.get('alias_domain', None)
-        if alias_domain is None:
-            ir_config_parameter = self.parent.pool.get("ir.config_parameter")
-            alias_domain = ir_config_parameter.get_param(self.parent.cr, self.parent.uid, "mail.catchall.domain")
-            print 'alias_domain', alias_domain
-            alias_domain = alias_domain or ''
-            self.parent.cache['alias_domain'] = alias_domain
+    def columns(self):
+        return set([self.field_name])
 
+    def __call__(self, external_values):
+        index = self.parent.email_index
         s = external_values.get(self.field_name, '')
         s = s.lower()
         res = []
         for email in re.findall('[^<>, ]*@[^<>, ]*', s):
-            if alias_domain and alias_domain == email.split('@')[1]:
-                res_users = self.parent.pool.get("res.users")
-                user_id = res_users.search(self.parent.cr, self.parent.uid,
-                                           [('alias_name','=', email.split('@')[0])])
-                if user_id:
-                    user_id = user_id[0]
-                    partner_id = res_users.browse(self.parent.cr, self.parent.uid,
-                                                  user_id).partner_id.id
-                    #tmp
-                    res.append(str(partner_id))
-                    continue
-                else:
-                    #print 'alias not found', email
-                    pass
-
-            #
-            partner_id = self.parent.pool['res.partner'].search(self.parent.cr,
-                                                                self.parent.uid,
-                                                                [('email', '=', email),
-                                                             ])
-
-
+            partner_id = index.find(self.parent.cr, email)
             if partner_id:
-                partner_id = partner_id[0]
-
-                #tmp
                 res.append(str(partner_id))
-                continue
-            else:
-                #print 'partner not found', email
-                pass
-
-        res = ','.join(res)
-        #print 'emails2partners', s, res
-        return res
+        return ','.join(res)
 
 
 class call(mapper):
@@ -381,6 +527,27 @@ class call(mapper):
         self.fun = fun
         self.arg = arg
     
+    def columns(self):
+        """
+            fields of mapper arguments and fields declared by the function
+            (see uses). The function gets all external values, so
+            None (all fields) is returned if it has no declaration.
+        """
+        if isinstance(self.fun, mapper):
+            columns = self.fun.columns()
+        else:
+            columns = getattr(self.fun, 'columns', None)
+        if columns is None:
+            return None
+        res = set(columns)
+        for arg in self.arg:
+            if isinstance(arg, mapper):
+                columns = arg.columns()
+                if columns is None:
+                    return None
+                res |= columns
+        return res
+
     def __call__(self, external_values):
         args = []
         for arg in self.arg:
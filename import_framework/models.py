@@ -0,0 +1,243 @@
+# -*- coding: utf-8 -*-
+from openerp.osv import osv, fields
+from openerp import tools
+import datetime
+import json
+import time
+import traceback
+import logging
+_logger = logging.getLogger(__name__)
+
+from import_base import import_cancelled
+
+# first key of advisory locks of running jobs, see import_framework_job._lock
+JOB_LOCK = 72381
+
+
+class import_framework_checkpoint(osv.Model):
+    _name = 'import_framework.checkpoint'
+    _description = 'Import checkpoint'
+    _order = 'id'
+
+    _columns = {
+        'instance_name': fields.char('Instance', required=True, select=True),
+        'table_name': fields.char('Table', required=True),
+        'model_num': fields.integer('Model #', help='Position of the model in the table mapping'),
+        'model': fields.char('Model'),
+        'batch': fields.integer('Batch', help='Number of imported split batch. -1 means that model is finalized'),
+        'rows_done': fields.integer('Rows done', help='Number of table rows processed by the model, including this batch'),
+    }
+
+
+class import_framework_fingerprint(osv.Model):
+    _name = 'import_framework.fingerprint'
+    _description = 'Fingerprint of imported row'
+
+    _columns = {
+        'instance_name': fields.char('Instance', required=True),
+        'table_name': fields.char('Table', required=True),
+        'external_id': fields.char('External ID', required=True),
+        'fingerprint': fields.char('Fingerprint', size=32, help='md5 of the row values'),
+    }
+
+    def _auto_init(self, cr, context=None):
+        res = super(import_framework_fingerprint, self)._auto_init(cr, context=context)
+        cr.execute("SELECT indexname FROM pg_indexes WHERE indexname = 'import_framework_fingerprint_key_index'")
+        if not cr.fetchone():
+            cr.execute('CREATE INDEX import_framework_fingerprint_key_index '
+                       'ON import_framework_fingerprint (instance_name, table_name, external_id)')
+        return res
+
+
+class import_framework_job(osv.Model):
+    """
+        Import running in background.
+
+        Job is created in Queued state by enqueue() and is run by the cron
+        "Run import jobs" (one job at a time), so it doesn't hold http worker.
+        The method `method` of model `res_model` is called as
+        method(cr, uid, params, context=context) and has to return
+        not yet run import_base instance.
+
+        Running job holds a lock (see _lock). If the worker dies
+        (e.g. by limit_time_real), the lock is released and the job
+        is marked as failed by the cron, so it can be resumed.
+    """
+    _name = 'import_framework.job'
+    _description = 'Import job'
+    _order = 'id desc'
+
+    _columns = {
+        'name': fields.char('Name', required=True, readonly=True),
+        'state': fields.selection([('draft', 'Queued'),
+                                   ('running', 'Running'),
+                                   ('done', 'Done'),
+                                   ('failed', 'Failed'),
+                                   ('cancel', 'Cancelled')], 'State', readonly=True),
+        'cancel_requested': fields.boolean('Cancel requested', readonly=True),
+        'res_model': fields.char('Model', required=True, readonly=True),
+        'method': fields.char('Method', required=True, readonly=True),
+        'params': fields.text('Parameters', readonly=True, help='JSON'),
+        'date_start': fields.datetime('Started', readonly=True),
+        'date_end': fields.datetime('Finished', readonly=True),
+        'table_name': fields.char('Table', readonly=True),
+        'model': fields.char('Importing model', readonly=True),
+        'batch': fields.integer('Batch', readonly=True),
+        'rows_done': fields.integer('Rows done', readonly=True, help='Rows of the table processed by the model'),
+        'rows_total': fields.integer('Rows total', readonly=True, help='Rows in the table'),
+        'tables_done': fields.integer('Tables done', readonly=True),
+        'rows_per_sec': fields.float('Rows/sec', readonly=True, digits=(16, 1)),
+        'eta': fields.datetime('Table ETA', readonly=True, help='Expected end of the current table'),
+        'log': fields.text('Log', readonly=True),
+    }
+    _defaults = {
+        'state': 'draft',
+    }
+
+    def enqueue(self, cr, uid, name, res_model, method, params, context=None):
+        """
+            @return: action to open the job
+        """
+        id = self.create(cr, uid, {'name': name,
+                                   'res_model': res_model,
+                                   'method': method,
+                                   'params': json.dumps(params),
+                                   }, context=context)
+        return {
+            'type': 'ir.actions.act_window',
+            'res_model': self._name,
+            'res_id': id,
+            'view_mode': 'form',
+            'target': 'current',
+        }
+
+    def _lock(self, cr, id):
+        """
+            Try to take the lock of the job till the end of cr transaction.
+            PostgreSQL releases it if the connection is lost.
+            @return: True if the lock is taken, i.e. nobody runs the job
+        """
+        cr.execute('SELECT pg_try_advisory_xact_lock(%s, %s)', (JOB_LOCK, id))
+        return cr.fetchone()[0]
+
+    def _stop_orphaned(self, cr, uid, ids, state, context=None):
+        """
+            set state of running jobs that nobody runs anymore
+            @return: ids of such jobs
+        """
+        res = []
+        for job in self.browse(cr, uid, ids, context=context):
+            if job.state != 'running' or not self._lock(cr, job.id):
+                continue
+            _logger.warning('import job %s (%s) was interrupted' % (job.id, job.name))
+            job.write({'state': state,
+                       'date_end': time.strftime(tools.DEFAULT_SERVER_DATETIME_FORMAT),
+                       'log': 'The import was interrupted (server restart or time limit). Resume it to continue.',
+                       })
+            res.append(job.id)
+        return res
+
+    def action_cancel(self, cr, uid, ids, context=None):
+        orphaned = self._stop_orphaned(cr, uid, ids, 'cancel', context=context)
+        for job in self.browse(cr, uid, ids, context=context):
+            if job.id in orphaned:
+                continue
+            if job.state == 'draft':
+                job.write({'state': 'cancel'})
+            elif job.state == 'running':
+                # checked after each batch, see report_progress
+                job.write({'cancel_requested': True})
+        return True
+
+    def action_resume(self, cr, uid, ids, context=None):
+        """
+            queue the job again, imported batches are skipped (see import_base resume option)
+        """
+        for job in self.browse(cr, uid, ids, context=context):
+            params = json.loads(job.params or '{}')
+            params['resume'] = True
+            job.write({'state': 'draft',
+                       'cancel_requested': False,
+                       'params': json.dumps(params),
+                       'log': False,
+                       })
+        return True
+
+    def _cron_run_jobs(self, cr, uid, context=None):
+        running = self.search(cr, uid, [('state', '=', 'running')], context=context)
+        self._stop_orphaned(cr, uid, running, 'failed', context=context)
+        cr.commit()
+        if self.search(cr, uid, [('state', '=', 'running')], context=context):
+            return True
+        ids = self.search(cr, uid, [('state', '=', 'draft')], order='id', limit=1, context=context)
+        if ids:
+            self.run_job(cr, uid, ids[0], context=context)
+        return True
+
+    def run_job(self, cr, uid, id, context=None):
+        # the lock is held by separate cursor, because cr is committed during the import
+        lock_cr = self.pool.cursor()
+        try:
+            if not self._lock(lock_cr, id):
+                _logger.info('import job %s is already running' % id)
+                return False
+            return self._run_job(cr, uid, id, context=context)
+        finally:
+            lock_cr.close()
+
+    def _run_job(self, cr, uid, id, context=None):
+        job = self.browse(cr, uid, id, context=context)
+        job.write({'state': 'running',
+                   'cancel_requested': False,
+                   'date_start': time.strftime(tools.DEFAULT_SERVER_DATETIME_FORMAT),
+                   'date_end': False,
+                   'tables_done': 0,
+                   })
+        cr.commit()
+        _logger.info('import job %s (%s) started' % (id, job.name))
+        vals = {}
+        instance = None
+        try:
+            params = json.loads(job.params or '{}')
+            instance = getattr(self.pool[job.res_model], job.method)(cr, uid, params, context=context)
+            if instance:
+                instance.job_id = id
+                instance.run()
+            vals['state'] = 'done'
+        except import_cancelled:
+            cr.rollback()
+            vals['state'] = 'cancel'
+        except Exception:
+            cr.rollback()
+            vals.update({'state': 'failed',
+                         'log': traceback.format_exc()})
+            _logger.exception('import job %s failed' % id)
+        if instance:
+            try:
+                instance.cleanup()
+            except Exception:
+                _logger.exception('import job %s: cleanup failed' % id)
+        vals['date_end'] = time.strftime(tools.DEFAULT_SERVER_DATETIME_FORMAT)
+        self.write(cr, uid, [id], vals, context=context)
+        cr.commit()
+        _logger.info('import job %s: %s' % (id, vals['state']))
+        return True
+
+    def report_progress(self, cr, uid, id, vals, context=None):
+        """
+            Write progress in separate transaction, so it's visible
+            while the import is running.
+            @raise import_cancelled: if cancel was requested
+        """
+        progress_cr = self.pool.cursor()
+        try:
+            if vals.get('rows_per_sec') and vals.get('rows_total'):
+                left = (vals['rows_total'] - vals.get('rows_done', 0)) / vals['rows_per_sec']
+                vals['eta'] = (datetime.datetime.utcnow() + datetime.timedelta(seconds=left)).strftime(tools.DEFAULT_SERVER_DATETIME_FORMAT)
+            self.write(progress_cr, uid, [id], vals, context=context)
+            cancel = self.read(progress_cr, uid, [id], ['cancel_requested'], context=context)[0]['cancel_requested']
+            progress_cr.commit()
+        finally:
+            progress_cr.close()
+        if cancel:
+            raise import_cancelled('import job %s is cancelled' % id)
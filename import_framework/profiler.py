@@ -0,0 +1,123 @@
+# -*- coding: utf-8 -*-
+import csv
+import json
+import time
+import threading
+from collections import OrderedDict
+import logging
+_logger = logging.getLogger(__name__)
+
+import mapper
+
+
+class timed_mapper(mapper.mapper):
+    """
+        Wrapper that adds time spent in the mapper to times[key]
+    """
+    def __init__(self, mapper, times, key):
+        self.mapper = mapper
+        self.times = times
+        self.key = key
+        times.setdefault(key, 0.0)
+
+    def __call__(self, external_values):
+        start = time.time()
+        try:
+            return self.mapper(external_values)
+        finally:
+            self.times[self.key] += time.time() - start
+
+    def vectorize(self, frame):
+        if not isinstance(self.mapper, mapper.mapper):
+            return None
+        start = time.time()
+        try:
+            return self.mapper.vectorize(frame)
+        finally:
+            self.times[self.key] += time.time() - start
+
+
+class import_profiler(object):
+    """
+        Collects statistics per table and per model mapping:
+
+        * rows_read - rows passed to the model (sum over split batches)
+        * rows_hooked - rows returned by the hook
+        * hook_time, mapping_time (per field), to_csv_time, base_import_time (seconds)
+    """
+    def __init__(self, instance_name):
+        self.instance_name = instance_name
+        self.started = time.time()
+        self.tables = OrderedDict()
+        self.lock = threading.Lock()
+
+    def table_stats(self, table):
+        with self.lock:
+            if table not in self.tables:
+                self.tables[table] = {'table': table,
+                                      'read_time': 0.0,
+                                      'models': OrderedDict()}
+            return self.tables[table]
+
+    def model_stats(self, table, model_num, model):
+        models = self.table_stats(table)['models']
+        if model_num not in models:
+            models[model_num] = {'model_num': model_num,
+                                 'model': model,
+                                 'rows_read': 0,
+                                 'rows_hooked': 0,
+                                 'chunks': 0,
+                                 'hook_time': 0.0,
+                                 'mapping_time': OrderedDict(),
+                                 'to_csv_time': 0.0,
+                                 'base_import_time': 0.0,
+                                 }
+        return models[model_num]
+
+    def wrap_fields(self, stats, mfields):
+        """
+            @return: copy of preprocessed mapping with timed mappers
+        """
+        times = stats['mapping_time']
+        res = {}
+        for key, val in mfields.items():
+            if isinstance(val, list):
+                res[key] = [timed_mapper(v, times, key) for v in val]
+            else:
+                res[key] = timed_mapper(val, times, key)
+        return res
+
+    def report(self):
+        tables = []
+        for t in self.tables.values():
+            t = dict(t)
+            t['models'] = t['models'].values()
+            tables.append(t)
+        return {'instance_name': self.instance_name,
+                'started': time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(self.started)),
+                'total_time': time.time() - self.started,
+                'tables': tables,
+                }
+
+    def save(self, path_prefix):
+        """
+            save report to PATH_PREFIX.json and PATH_PREFIX.csv
+            @return: list of file names
+        """
+        report = self.report()
+        json_file = path_prefix + '.json'
+        with open(json_file, 'w') as f:
+            json.dump(report, f, indent=2)
+
+        csv_file = path_prefix + '.csv'
+        with open(csv_file, 'wb') as f:
+            writer = csv.writer(f)
+            writer.writerow(['table', 'model_num', 'model', 'metric', 'field', 'value'])
+            for t in report['tables']:
+                writer.writerow([t['table'], '', '', 'read_time', '', t['read_time']])
+                for m in t['models']:
+                    for metric in ['rows_read', 'rows_hooked', 'chunks', 'hook_time', 'to_csv_time', 'base_import_time']:
+                        writer.writerow([t['table'], m['model_num'], m['model'], metric, '', m[metric]])
+                    for field, seconds in m['mapping_time'].items():
+                        writer.writerow([t['table'], m['model_num'], m['model'], 'mapping_time', field, seconds])
+        return [json_file, csv_file]
@@ -0,0 +1,126 @@
+# -*- coding: utf-8 -*-
+from openerp import tools
+import json
+import os
+import threading
+import logging
+_logger = logging.getLogger(__name__)
+
+try:
+    from cStringIO import StringIO
+except ImportError:
+    from StringIO import StringIO
+
+try:
+    from pandas import read_csv
+except ImportError:
+    pass
+
+try:
+    import pyarrow
+    import pyarrow.parquet
+except ImportError:
+    pyarrow = None
+
+from bulk_load import is_empty
+
+FORMATS = ['csv', 'parquet']
+
+
+class staging_area(object):
+    """
+        Batches prepared for import are saved to import_dir and listed
+        in manifest-INSTANCE.jsonl, so they can be imported again
+        (see import_base.replay_staged) without reading the source and mapping.
+
+        format 'csv' - file as it's sent to base_import
+        format 'parquet' - columnar file, requires pyarrow.
+                           Values are saved as strings, as they would be in csv.
+                           It's read memory-mapped on replay.
+    """
+    def __init__(self, import_dir, instance_name, format='csv'):
+        if format not in FORMATS:
+            raise Exception('staging: unknown format %s' % format)
+        if format == 'parquet' and pyarrow is None:
+            raise Exception('staging: pyarrow is required for parquet format')
+        self.import_dir = import_dir
+        self.format = format
+        self.manifest = os.path.join(import_dir, 'manifest-%s.jsonl' % instance_name)
+        self.lock = threading.Lock()
+
+    def clear(self):
+        if os.path.exists(self.manifest):
+            os.remove(self.manifest)
+
+    def entries(self):
+        if not os.path.exists(self.manifest):
+            return []
+        with open(self.manifest) as f:
+            return [json.loads(line) for line in f if line.strip()]
+
+    def last_num(self):
+        return max([e.get('num', 0) for e in self.entries()] or [0])
+
+    def _append(self, entry):
+        with self.lock:
+            with open(self.manifest, 'a') as f:
+                f.write(json.dumps(entry) + '\n')
+
+    def save(self, num, table, model_num, model, fields, frame, data_binary):
+        """
+            @param frame: mapped rows, columns are in order of fields
+            @param data_binary: the same rows as csv
+            @return: file name
+        """
+        file_name = '%s/import-%03d-%s.%s' % (self.import_dir, num, model, self.format)
+        if self.format == 'parquet':
+            frame = frame.applymap(lambda value: None if is_empty(value) else tools.ustr(value))
+            frame.columns = fields
+            pyarrow.parquet.write_table(pyarrow.Table.from_pandas(frame, preserve_index=False), file_name)
+        else:
+            with open(file_name, 'w') as f:
+                f.write(data_binary)
+        self._append({'num': num,
+                      'table': table,
+                      'model_num': model_num,
+                      'model': model,
+                      'fields': list(fields),
+                      'file': file_name,
+                      'format': self.format,
+                      'rows': len(frame),
+                      })
+        return file_name
+
+    def save_finalize(self, table, model_num):
+        """
+            mark that finalize of the model was called
+        """
+        self._append({'table': table,
+                      'model_num': model_num,
+                      'finalize': True,
+                      })
+
+    def load(self, entry, import_options, frame=True):
+        """
+            @param frame: whether DataFrame is needed
+            @return: (DataFrame or None, csv data)
+        """
+        if entry['format'] == 'parquet':
+            res = pyarrow.parquet.read_table(entry['file'], memory_map=True).to_pandas()
+            data_binary = res.to_csv(sep=import_options.get('separator'),
+                                     quotechar=import_options.get('quoting'),
+                                     index=False,
+                                     header=entry['fields'],
+                                     encoding='utf-8')
+            return res, data_binary
+        with open(entry['file']) as f:
+            data_binary = f.read()
+        res = None
+        if frame:
+            res = read_csv(StringIO(data_binary),
+                           sep=import_options.get('separator'),
+                           quotechar=import_options.get('quoting'),
+                           dtype=object,
+                           keep_default_na=False,
+                           encoding='utf-8')
+        return res, data_binary
@@ -9,6 +9,8 @@ try:
 except ImportError:
     pass
 from openerp.addons.import_framework.import_base import import_base
+from openerp.addons.import_framework.csv_source import csv_source
+from openerp.addons.import_framework.bulk_load import create_xml_ids
 
 from openerp.addons.import_framework.mapper import *
 
@@ -16,12 +18,8 @@ import re
 
 import time
 import datetime as DT
-
-try:
-    from cStringIO import StringIO
-except ImportError:
-    from StringIO import StringIO
-import csv
+import bisect
+import threading
 
 class fix_kashflow_date(mapper):
     """
@@ -38,19 +36,111 @@ class fix_kashflow_date(mapper):
         return '%s-%s-%s' % (y,m,d)
 
 
+class period_index(object):
+    """
+        Periods of companies sorted by date_start:
+        company_id -> (date_start list, max date_stop up to each period, periods)
+
+        Each company is loaded with one query (see load), then periods
+        are found by binary search, the same way as account.period.find does:
+        first period in order of account.period containing the date,
+        not special period is preferred.
+    """
+    def __init__(self):
+        self.companies = {}
+
+    def load(self, cr, company_id):
+        cr.execute('SELECT date_start, date_stop, id, special FROM account_period '
+                   'WHERE company_id = %s ORDER BY date_start, special DESC, id', (company_id,))
+        periods = [(str(start), str(stop), id, special) for start, stop, id, special in cr.fetchall()]
+        max_stop = []
+        for p in periods:
+            max_stop.append(max(max_stop and max_stop[-1] or p[1], p[1]))
+        self.companies[company_id] = ([p[0] for p in periods], max_stop, periods)
+
+    def find(self, cr, company_id, date):
+        """
+            @param date: 'YYYY-MM-DD'
+            @return: period id or None
+        """
+        if company_id not in self.companies:
+            self.load(cr, company_id)
+        starts, max_stop, periods = self.companies[company_id]
+        found = []
+        # periods up to i start not later than date,
+        # none of them contains date if max_stop[i] < date
+        i = bisect.bisect_right(starts, date) - 1
+        while i >= 0 and max_stop[i] >= date:
+            if periods[i][1] >= date:
+                found.append(periods[i])
+            i -= 1
+        found.reverse()
+        for start, stop, id, special in found:
+            if not special:
+                return id
+        return found and found[0][2] or None
+
+
+def normalize_name(name):
+    return ' '.join(tools.ustr(name).lower().split())
+
+
+class partner_name_index(object):
+    """
+        normalized name of active partner -> set of ids, see normalize_name
+
+        Loaded with one query on first refresh, then each refresh
+        adds partners created since previous one.
+        Shared by all workers (see import_base.clone) like import_framework.index.
+    """
+    def __init__(self):
+        self.names = {}
+        self.last_id = 0
+        self.lock = threading.RLock()
+
+    def refresh(self, cr):
+        with self.lock:
+            cr.execute('SELECT id, name FROM res_partner WHERE active AND id > %s ORDER BY id', (self.last_id,))
+            for id, name in cr.fetchall():
+                if name:
+                    self.names.setdefault(normalize_name(name), set()).add(id)
+                self.last_id = id
+
+    def find(self, name):
+        """
+            @return: id of the only partner with the name or None
+        """
+        ids = self.names.get(normalize_name(name), ())
+        if len(ids) != 1:
+            return None
+        return iter(ids).next()
+
+
 class date_to_period(fix_kashflow_date, dbmapper):
+    """
+        Use : date_to_period(field_name, context)
+        return id of period of company context()['company_id'], see period_index
+    """
     def __init__(self, field_name, context):
         super(date_to_period, self).__init__(field_name)
-        self.context = context()
+        self.context = context
+        self.company_id = None
 
     def __call__(self, external_values):
         s = super(date_to_period, self).__call__(external_values)
+        if not s:
+            return ''
+        if self.company_id is None:
+            # company is created by previous tables
+            self.company_id = self.context().get('company_id') or \
+                self.parent.pool['res.users'].browse(self.parent.cr, self.parent.uid, self.parent.uid).company_id.id
 
         dt = DT.datetime.strptime(s, tools.DEFAULT_SERVER_DATE_FORMAT)
-        period_ids = self.parent.pool.get('account.period').find(self.parent.cr, self.parent.uid, dt=dt, context=self.context)
-        if not period_ids:
-            print 'period_ids not found', s
-        return period_ids and str(period_ids[0]) or ''
+        period_id = self.parent.period_index.find(self.parent.cr, self.company_id,
+                                                  dt.strftime(tools.DEFAULT_SERVER_DATE_FORMAT))
+        if not period_id:
+            _logger.warning('period not found: %s' % s)
+        return period_id and str(period_id) or ''
 
 
 
@@ -69,6 +159,7 @@ class import_kashflow(import_base):
 
     COL_ID_CUSTOM = 'id'
     COL_LINE_NUM = 'line_num'
+    STREAM_CHUNK_SIZE = 10000
 
     COL_NOMINAL_CODE = 'Nominal Code'
     COL_NOMINAL_CODE_NAME = 'Name'
@@ -97,6 +188,10 @@ class import_kashflow(import_base):
     COL_P_SOURCE = 'Source'
 
     def initialize(self):
+        self.period_index = period_index()
+        # see get_prepare_existed_partners
+        self.partner_name_index = partner_name_index()
+        self.existed_partners = set()
         # files:
         # COMPANY_NAME-customers.csv
         # COMPANY_NAME-suppliers.csv
@@ -115,25 +210,25 @@ class import_kashflow(import_base):
 
         self.companies = [{'name':c} for c in companies]
 
-    def get_data(self, table):
+    def get_data(self, table, chunk_size=None):
+        """
+            @return: DataFrame or, if chunk_size is set, iterator of DataFrames (see import_framework.csv_source)
+        """
         file_name = filter(lambda f: f.endswith('/%s.csv' % table), self.csv_files)
         if file_name:
             _logger.info('read file "%s"' % ( '%s.csv' % table))
             file_name = file_name[0]
         else:
             _logger.info('file not found %s' % ( '%s.csv' % table))
-            return []
+            return chunk_size and [] or DataFrame()
 
-        with open(file_name, 'rb') as csvfile:
-            fixed_file = StringIO(csvfile.read() .replace('\r\n', '\n'))
-        reader = csv.DictReader(fixed_file,
+        source = csv_source(file_name,
                             delimiter = self.import_options.get('separator'),
-                            #quotechar = self.import_options.get('quoting'),
+                            line_num_column = self.COL_LINE_NUM,
                             )
-        res = list(reader)
-        for line_num, line in enumerate(res):
-            line[self.COL_LINE_NUM] = str(line_num)
-        return res
+        if chunk_size:
+            return source.iter_chunks(chunk_size)
+        return source.read()
 
     def get_mapping(self):
         res = [self.get_mapping_company()]
@@ -168,6 +263,7 @@ class import_kashflow(import_base):
                     'company_id': company_id
                     })
                 self.pool.get('account.fiscalyear').create_period3(self.cr, self.uid, [year_id])
+            self.period_index.load(self.cr, company_id)
 
     def get_mapping_company(self):
         return {
@@ -196,18 +292,42 @@ class import_kashflow(import_base):
                 ]
             }
 
-    def get_table(self, company, table):
+    def get_table(self, company, table, chunk_size=None):
         def f():
-            t = DataFrame(self.get_data(company + table))
+            t = self.get_data(company + table, chunk_size=chunk_size)
             return t
         return f
-    def get_partner_by_name(self, name):
-        id = self.pool['res.partner'].search(self.cr, self.uid, [('name','=', name)])
-        if isinstance(id, list):
-            if len(id)!=1:
-                return None
-            id = id[0]
-        return id
+    def get_prepare_existed_partners(self, xml_id_mapper, field_name, another_hook=None):
+        """
+            Classify rows of the batch at once: rows with name of existed partner
+            (see partner_name_index) get xml id referring to that partner
+            and are skipped by get_hook_check_existed_partners.
+            Missed xml ids are created with one COPY.
+        """
+        def f(records):
+            xml_id_mapper.set_parent(self)
+            self.partner_name_index.refresh(self.cr)
+            data = {}
+            for key, r in records.iterrows():
+                external_values = dict(r)
+                if another_hook:
+                    external_values = another_hook(external_values)
+                    if not external_values:
+                        continue
+                name = external_values.get(field_name)
+                if not name:
+                    continue
+                id = self.partner_name_index.find(name)
+                if not id:
+                    continue
+                data_name = xml_id_mapper(external_values)
+                self.existed_partners.add(data_name)
+                if not self.xmlid_index.get(self.cr, '', data_name):
+                    # create new reference to existed record
+                    data[data_name] = id
+            create_xml_ids(self, 'res.partner', [('', data_name, id) for data_name, id in data.items()])
+            _logger.info('existed partners: %s references created' % len(data))
+        return f
 
     def get_hook_check_existed_partners(self, xml_id_mapper, field_name, another_hook=None):
         def f(external_values):
@@ -218,23 +338,9 @@ class import_kashflow(import_base):
             name = external_values.get(field_name)
             if not name:
                 return None
-            id = self.get_partner_by_name(name)
-            if id:
-                # create new reference to existed record
-                xml_id_mapper.set_parent(self)
-                data_name = xml_id_mapper(external_values)
-
-                if self.pool.get('ir.model.data').search(self.cr, self.uid, [('name', '=', data_name)]):
-                    # already created
-                    return None
-
-                vals = {'name': data_name,
-                        'model': 'res.partner',
-                        #'module': self.module_name,
-                        'module': '',
-                        'res_id': id,
-                    }
-                self.pool.get('ir.model.data').create(self.cr, self.uid, vals, context=self.context)
+            xml_id_mapper.set_parent(self)
+            if xml_id_mapper(external_values) in self.existed_partners:
+                # reference to existed record, see get_prepare_existed_partners
                 return None
             return external_values # create new partner
         return f
@@ -249,6 +355,7 @@ class import_kashflow(import_base):
                 'dependencies' : [self.TABLE_COMPANY],
                 'models':[
                     {'model' : 'res.partner',
+                     'prepare': self.get_prepare_existed_partners(xml_id(table, self.COL_P_CODE), self.COL_P_NAME),
                      'hook': self.get_hook_check_existed_partners(xml_id(table, self.COL_P_CODE), self.COL_P_NAME),
                      'fields': {
                          'id': xml_id(table, self.COL_P_CODE),
@@ -266,6 +373,7 @@ class import_kashflow(import_base):
                          }
                      },
                     {'model' : 'res.partner',
+                     'prepare': self.get_prepare_existed_partners(xml_id(table+'_child', self.COL_P_CODE), self.COL_P_FULL_NAME, self.get_hook_ignore_empty(self.COL_P_MOBILE, self.COL_P_FULL_NAME)),
                      'hook': self.get_hook_check_existed_partners(xml_id(table+'_child', self.COL_P_CODE), self.COL_P_FULL_NAME, self.get_hook_ignore_empty(self.COL_P_MOBILE, self.COL_P_FULL_NAME)),
                      'fields': {
                          'id': xml_id(table+'_child', self.COL_P_CODE),
@@ -291,11 +399,7 @@ class import_kashflow(import_base):
     def get_hook_account_account(self, company):
         def f(external_values):
             id = self.get_xml_id(company + self.TABLE_NOMINAL_CODES, self.COL_NOMINAL_CODE, external_values)
-            res_id = self.pool.get('ir.model.data').xmlid_to_res_id(
-                self.cr,
-                self.uid,
-                '.'+id
-            )
+            res_id = self.xmlid_to_res_id('.'+id)
             if res_id:
                 # account already created
                 return None
@@ -306,11 +410,7 @@ class import_kashflow(import_base):
 
     def hook_account_account_root(self, external_values):
         id = self.get_xml_id(self.TABLE_NOMINAL_CODES_ROOT, 'name', external_values)
-        res_id = self.pool.get('ir.model.data').xmlid_to_res_id(
-            self.cr,
-            self.uid,
-            '.'+id
-        )
+        res_id = self.xmlid_to_res_id('.'+id)
         if res_id:
             # account already created
             return None
@@ -493,7 +593,8 @@ class import_kashflow(import_base):
         partner = company + self.TABLE_PARTNER
         return {
             'name': table,
-            'table': self.get_table(company, self.TABLE_TRANSACTION),
+            'table': self.get_table(company, self.TABLE_TRANSACTION, chunk_size=self.STREAM_CHUNK_SIZE),
+            'stream': True,
             'dependencies' : [company + self.TABLE_JOURNAL,
                               company + self.TABLE_NOMINAL_CODES,
                               company + self.TABLE_CUSTOMER,
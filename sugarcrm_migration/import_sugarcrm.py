@@ -10,13 +10,123 @@ except ImportError:
     pass
 
 from openerp.addons.import_framework.import_base import import_base, create_childs
+from openerp.addons.import_framework.index import frame_cache
+from mysqldump import mysqldump_reader
 
 from openerp.addons.import_framework.mapper import *
 import subprocess
+from collections import OrderedDict
 
 def fix_email(text):
     return text.replace('\r', '<br>')
 
+FILTER_MODULES = ['Accounts', 'Cases', 'Contacts', 'Notes', 'Emails']
+
+class sql_join(object):
+    """
+        Builder of SELECT with joins and filters of SugarCRM tables,
+        so MySQL joins them by its indexes and only needed rows are sent.
+
+        Result columns are named the way pandas.merge names them
+        (suffixes for overlapping names), so the same mapping works with
+        sql_join and with merged DataFrames.
+
+        Use :
+            q = sql_join(self, 'emails', keys=['id'])
+            q.join('emails_text', 'id', 'email_id', how='left')
+            q.where_in('bean_module', FILTER_MODULES)
+            frame = q.fetch()
+    """
+    def __init__(self, parent, table, keys=()):
+        self.parent = parent
+        self.table = table
+        self.columns = OrderedDict() # result name -> sql expression
+        self.joins = []
+        self.conditions = []
+        self.params = []
+        # stable order of rows, see import_sugarcrm.get_primary_key
+        self.order = ['t0.`%s`' % c for c in parent.get_primary_key(table)]
+        for c in self._table_columns(table, keys):
+            self.columns[c] = 't0.`%s`' % c
+
+    def _table_columns(self, table, keys):
+        return self.parent.select_list(table, keys) or self.parent.get_source_columns(table)
+
+    def join(self, table, left_on, right_on, how='inner', suffixes=('_x', '_y'), keys=()):
+        """
+            same as merge(result, table, how=how, left_on=left_on, right_on=right_on, suffixes=suffixes)
+        """
+        alias = 't%s' % (len(self.joins) + 1)
+        right = self._table_columns(table, list(keys) + [right_on])
+        self.joins.append('%s JOIN %s %s ON %s = %s.`%s`' % (how == 'left' and 'LEFT' or 'INNER',
+                                                            table, alias, self.columns[left_on], alias, right_on))
+        self.order.extend('%s.`%s`' % (alias, c) for c in self.parent.get_primary_key(table))
+        overlap = set(self.columns) & set(right)
+        columns = OrderedDict()
+        for name, expr in self.columns.items():
+            columns[name in overlap and name + suffixes[0] or name] = expr
+        for c in right:
+            columns[c in overlap and c + suffixes[1] or c] = '%s.`%s`' % (alias, c)
+        self.columns = columns
+        return self
+
+    def where_in(self, column, values):
+        self.conditions.append('%s IN (%s)' % (self.columns[column], ','.join(['%s'] * len(values))))
+        self.params.extend(values)
+        return self
+
+    def where_not_null(self, column):
+        self.conditions.append('%s IS NOT NULL' % self.columns[column])
+        return self
+
+    def sql(self):
+        query = 'SELECT %s FROM %s t0' % (', '.join('%s AS `%s`' % (expr, name) for name, expr in self.columns.items()),
+                                          self.table)
+        if self.joins:
+            query += ' ' + ' '.join(self.joins)
+        if self.conditions:
+            query += ' WHERE ' + ' AND '.join(self.conditions)
+        if self.order:
+            query += ' ORDER BY ' + ', '.join(self.order)
+        return query
+
+    def fetch(self):
+        """
+            Results are cached in parent.table_cache by the query text,
+            so the same query is executed once. Returned frame is shared,
+            don't modify it.
+            @return: DataFrame
+        """
+        query = self.sql()
+        key = ('sql', query, tuple(self.params))
+        res = self.parent.table_cache.get(key)
+        if res is not None:
+            return res
+        cur = self.parent.db.cursor()
+        cur.execute(query, self.params)
+        res = DataFrame(list(cur.fetchall()), columns=list(self.columns))
+        cur.close()
+        self.parent.table_cache.set(key, res)
+        return res
+
+    def iter_fetch(self, chunk_size):
+        """
+            read result with server-side cursor, see import_sugarcrm.iter_data
+            @return: iterator of DataFrames of chunk_size rows
+        """
+        db = self.parent.connect(cursorclass=MySQLdb.cursors.SSDictCursor)
+        try:
+            cur = db.cursor()
+            cur.execute(self.sql(), self.params)
+            while True:
+                rows = cur.fetchmany(chunk_size)
+                if not rows:
+                    break
+                yield DataFrame(list(rows), columns=list(self.columns))
+            cur.close()
+        finally:
+            db.close()
+
 class import_sugarcrm(import_base):
 
     TABLE_USER = 'users'
@@ -43,22 +153,48 @@ class import_sugarcrm(import_base):
     TABLE_NOTE = 'Notes'
     TABLE_NOTE_INTERNAL = 'notes_internal'
     TABLE_EMAIL = 'emails'
+    STREAM_CHUNK_SIZE = 10000
+    TABLE_CACHE_MB = 1024
     #TABLE_COMPAIGN = 'Campaigns'
     #TABLE_DOCUMENT = 'Documents'
     #TABLE_HISTORY_ATTACHMNET = 'history_attachment'
     
 
 
+    def connect(self, cursorclass=None):
+        return MySQLdb.connect(host=self.context.get('db_host'),
+                               port=int(self.context.get('db_port')),
+                               user=self.context.get('db_user'),
+                               passwd=self.context.get('db_passwd'),
+                               db=self.context.get('db_name'),
+                               charset='utf8',
+                               cursorclass=cursorclass or MySQLdb.cursors.DictCursor
+                           )
+
+    def init_worker(self):
+        if self.dump:
+            return
+        # MySQLdb connection can't be shared between threads
+        self.db = self.connect()
+
     def initialize(self):
-        self.db = MySQLdb.connect(host=self.context.get('db_host'),
-                                  port=int(self.context.get('db_port')),
-                                  user=self.context.get('db_user'),
-                                  passwd=self.context.get('db_passwd'),
-                                  db=self.context.get('db_name'),
-                                  charset='utf8',
-                                  cursorclass=MySQLdb.cursors.DictCursor
-                              )
+        self.source_columns = {}
+        self.primary_keys = {}
+        # see prepare_targets
+        self.targets = {}
+        self.projects = {}
+        # source tables read during the run, see get_data
+        self.table_cache = frame_cache(int(self.context.get('table_cache_mb', self.TABLE_CACHE_MB)) * 1024 * 1024)
+        self.dump = None
+        if self.replay:
+            # staged batches are imported, see import_base.replay_staged
+            return
         db_dump_fies = self.context.get('db_dump_fies')
+        if db_dump_fies and not self.context.get('db_host'):
+            # no MySQL server, tables are read from dump files
+            self.dump = mysqldump_reader(db_dump_fies)
+            return
+        self.db = self.connect()
         if db_dump_fies:
             cur = self.db.cursor()
             for f in db_dump_fies:
@@ -75,26 +211,195 @@ class import_sugarcrm(import_base):
             cur.close()
 
     def finalize(self):
-        pass
+        _logger.info('table_cache: %(entries)s frames, hit rate %(hit_rate).2f '
+                     '(%(hits)s hits, %(misses)s misses), memory %(memory)s bytes' % self.table_cache.stats())
 
     def finalize_note(self):
+        """
+            Link attachments to messages (res_id_tmp) with one INSERT
+            into relation table of mail.message.attachment_ids
+            and clear temporary columns
+        """
         mail_message_obj = self.pool['mail.message']
-        ids = self.pool['ir.attachment'].search(self.cr, self.uid, [('res_model_tmp','=','mail.message')])
-        for a in self.pool['ir.attachment'].read(self.cr, self.uid, ids, ['id', 'res_id_tmp'], context=self.context):
-            if not a['res_id_tmp']:
-                continue
-            mail_message_obj.write(self.cr, self.uid, [a['res_id_tmp']],
-                                   {'attachment_ids':[(4, a['id'])]})
-
-
-    def get_data(self, table):
+        column = mail_message_obj._columns['attachment_ids']
+        self.cr.execute('INSERT INTO %(rel)s (%(id1)s, %(id2)s) '
+                        'SELECT DISTINCT a.res_id_tmp, a.id FROM ir_attachment a '
+                        'JOIN mail_message m ON m.id = a.res_id_tmp '
+                        "WHERE a.res_model_tmp = 'mail.message' "
+                        'AND NOT EXISTS (SELECT 1 FROM %(rel)s r WHERE r.%(id1)s = a.res_id_tmp AND r.%(id2)s = a.id)'
+                        % {'rel': column._rel, 'id1': column._id1, 'id2': column._id2})
+        _logger.info('finalize_note: %s attachments linked to messages' % self.cr.rowcount)
+        self.cr.execute("UPDATE ir_attachment SET res_model_tmp = NULL, res_id_tmp = NULL "
+                        "WHERE res_model_tmp = 'mail.message'")
+        mail_message_obj.invalidate_cache(self.cr, self.uid, ['attachment_ids'], context=self.context)
+
+
+    def get_source_columns(self, table):
+        if self.dump:
+            return self.dump.columns(table)
+        columns = self.source_columns.get(table)
+        if columns is None:
+            cur = self.db.cursor()
+            cur.execute("SHOW COLUMNS FROM %s" % table)
+            columns = [r['Field'] for r in cur.fetchall()]
+            cur.close()
+            self.source_columns[table] = columns
+        return columns
+
+    def get_primary_key(self, table):
+        """
+            Resume (see import_base.map_and_import) skips rows by position,
+            so tables are read in order of primary key to get the same
+            order in every run. Rows of dump files are in file order.
+            @return: list of primary key columns
+        """
+        if self.dump:
+            return []
+        columns = self.primary_keys.get(table)
+        if columns is None:
+            cur = self.db.cursor()
+            cur.execute("SHOW KEYS FROM %s WHERE Key_name = 'PRIMARY'" % table)
+            columns = [r['Column_name'] for r in sorted(cur.fetchall(), key=lambda r: r['Seq_in_index'])]
+            cur.close()
+            self.primary_keys[table] = columns
+        return columns
+
+    def order_by(self, table):
+        columns = self.get_primary_key(table)
+        if not columns:
+            return ''
+        return ' ORDER BY ' + ','.join('`%s`' % c for c in columns)
+
+    def select_list(self, table, keys=()):
+        """
+            @param keys: columns needed to join or filter the table
+            @return: columns of the table used by mapping of the table
+                     in progress (see import_base.get_table_columns)
+                     or None if all columns are needed.
+                     Columns with suffix added by merge (e.g. 'email_id_emails_beans')
+                     are recognized by prefix.
+        """
+        needed = self.table_columns
+        if needed is None:
+            return None
+        res = [c for c in self.get_source_columns(table)
+               if c in needed or c in keys or any(n.startswith(c + '_') for n in needed)]
+        return res or None
+
+    def select_columns(self, table, keys=()):
+        columns = self.select_list(table, keys)
+        if columns is None:
+            return '*'
+        return ','.join('`%s`' % c for c in columns)
+
+    def get_data(self, table, keys=()):
+        """
+            Tables are cached for the run, so a table used by several
+            mappings is read once. Cached frame is reused if it has
+            all needed columns, otherwise the table is read again with
+            columns for both.
+            @return: DataFrame
+        """
+        requested = self.select_list(table, keys)
+        columns = requested
+        cached = self.table_cache.get(table)
+        if cached is not None:
+            if set(requested or self.get_source_columns(table)) <= set(cached.columns):
+                if requested is None:
+                    return cached
+                return cached[requested]
+            if requested is not None:
+                columns = [c for c in self.get_source_columns(table)
+                           if c in requested or c in cached.columns]
+
+        if self.dump:
+            res = DataFrame(self.dump.read(table, columns), columns=columns or self.dump.columns(table))
+        else:
+            cur = self.db.cursor()
+            query = "SELECT %s FROM %s" % (columns is None and '*' or ','.join('`%s`' % c for c in columns), table)
+            query += self.order_by(table)
+            #query = query + ' order by rand()' # for debug
+            cur.execute(query)
+            res = DataFrame(list(cur.fetchall()), columns=[d[0] for d in cur.description])
+            cur.close()
+        if columns is None:
+            self.source_columns[table] = list(res.columns)
+        self.table_cache.set(table, res)
+        if requested is None:
+            return res
+        return res[requested]
+
+    def get_data_in(self, table, field_name, values, keys=()):
+        """
+            @return: DataFrame of rows with field_name in values
+        """
+        keys = list(keys) + [field_name]
+        values = list(set(values))
+        if self.dump:
+            t = self.get_data(table, keys)
+            return t[t[field_name].isin(values)]
         cur = self.db.cursor()
-        query = "SELECT * FROM %s" % table
-        #query = query + ' order by rand()' # for debug
-        cur.execute(query)
-        res = cur.fetchall()
+        if values:
+            query = "SELECT %s FROM %s WHERE %s IN (%s)" % (self.select_columns(table, keys), table,
+                                                             field_name, ','.join(['%s'] * len(values)))
+            query += self.order_by(table)
+            cur.execute(query, values)
+        else:
+            cur.execute("SELECT %s FROM %s LIMIT 0" % (self.select_columns(table, keys), table))
+        res = DataFrame(list(cur.fetchall()), columns=[d[0] for d in cur.description])
         cur.close()
-        return list(res)
+        return res
+
+    def iter_data(self, table, chunk_size=None, keys=()):
+        """
+            Read table with server-side cursor.
+            Separate connection is used, because the main one
+            can't run other queries until the result is read.
+            @return: iterator of DataFrames of chunk_size rows
+        """
+        chunk_size = chunk_size or self.get_stream_chunk_size()
+        if self.dump:
+            columns = self.select_list(table, keys) or self.dump.columns(table)
+            for rows in self.dump.iter_chunks(table, chunk_size, columns):
+                yield DataFrame(rows, columns=columns)
+            return
+        db = self.connect(cursorclass=MySQLdb.cursors.SSDictCursor)
+        try:
+            cur = db.cursor()
+            cur.execute("SELECT %s FROM %s" % (self.select_columns(table, keys), table) + self.order_by(table))
+            while True:
+                rows = cur.fetchmany(chunk_size)
+                if not rows:
+                    break
+                yield DataFrame(list(rows))
+            cur.close()
+        finally:
+            db.close()
+
+    def use_sql_joins(self):
+        """
+            join and filter tables in MySQL (see sql_join) instead of pandas.
+            Not available for tables read from dump files.
+            Joined results are cached per query, tables are not shared
+            between different queries as get_data does.
+        """
+        return not self.dump and bool(self.context.get('sql_joins', True))
+
+    def join_table_email(self, q, id_on='id'):
+        """
+            sql_join version of merge_table_email
+        """
+        q.join('email_addr_bean_rel', id_on, 'bean_id', how='left',
+               suffixes=('', '_email_addr_bean_rel'), keys=['email_address_id'])
+        q.join('email_addresses', 'email_address_id', 'id', how='left',
+               suffixes=('', '_email_addresses'))
+        return q
+
+    def get_stream_chunk_size(self):
+        """
+            rows per chunk of streamed tables, 0 to read tables at once
+        """
+        return int(self.context.get('stream_chunk_size', self.STREAM_CHUNK_SIZE))
 
     def get_mapping(self):
         res = [
@@ -119,23 +424,36 @@ class import_sugarcrm(import_base):
 #| Users       |       33 |
 #+-------------+----------+
 #4 rows in set (0.21 sec)
-        t1 = merge(df,
-                   DataFrame(self.get_data('email_addr_bean_rel')),
+        rel = self.get_data('email_addr_bean_rel', keys=['bean_id', 'email_address_id'])
+        addresses = self.get_data('email_addresses', keys=['id'])
+        # the join of the two tables is the same for all entities
+        key = ('email_addr_bean_rel', tuple(rel.columns), 'email_addresses', tuple(addresses.columns))
+        t1 = self.table_cache.get(key)
+        if t1 is None:
+            t1 = merge(rel,
+                       addresses,
+                       how='left',
+                       left_on = 'email_address_id',
+                       suffixes=('', '_email_addresses'),
+                       right_on = 'id')
+            self.table_cache.set(key, t1)
+        t2 = merge(df,
+                   t1,
                    how='left',
                    left_on=id_on,
                    suffixes=('', '_email_addr_bean_rel'),
                    right_on='bean_id')
-        t2 = merge(t1,
-                   DataFrame(self.get_data('email_addresses')),
-                   how='left',
-                   left_on = 'email_address_id',
-                   suffixes=('', '_email_addresses'),
-                   right_on = 'id')
-
+        # columns of email_addresses are named as if df was merged
+        # with email_addr_bean_rel and then with email_addresses
+        t2 = t2.rename(columns=dict((c + '_email_addr_bean_rel', c + '_email_addresses')
+                                    for c in addresses.columns
+                                    if c not in rel.columns and c in df.columns))
         return t2
 
     def table_user(self):
-        t1 = self.merge_table_email(DataFrame(self.get_data('users')))
+        if self.use_sql_joins():
+            return self.join_table_email(sql_join(self, 'users', keys=['id'])).fetch()
+        t1 = self.merge_table_email(DataFrame(self.get_data('users', keys=['id'])))
         return t1
 
     def get_mapping_user(self):
@@ -146,7 +464,7 @@ class import_sugarcrm(import_base):
                 'model' : 'res.users',
 'fields': {
                 'id': xml_id(self.TABLE_USER, 'id'),
-                'active': lambda record: not record['deleted'], # status == 'Active'
+                'active': uses('deleted')(lambda record: not record['deleted']), # status == 'Active'
                 'name': concat('first_name', 'last_name'),
                  'login': value('user_name', fallback='last_name'),
                  'password' : 'user_hash',
@@ -158,8 +476,11 @@ class import_sugarcrm(import_base):
             }
     
     def table_account(self):
-        t1 = merge(DataFrame(self.get_data('accounts')),
-                   DataFrame(self.get_data('accounts_cstm')),
+        if self.use_sql_joins():
+            q = sql_join(self, 'accounts', keys=['id']).join('accounts_cstm', 'id', 'id_c')
+            return q.fetch()
+        t1 = merge(DataFrame(self.get_data('accounts', keys=['id'])),
+                   DataFrame(self.get_data('accounts_cstm', keys=['id_c'])),
                    left_on='id',
                    right_on='id_c'
         )
@@ -167,6 +488,7 @@ class import_sugarcrm(import_base):
         return t1
 
     def get_hook_tag(self, field_name):
+        @uses(field_name)
         def f(external_values):
             res = []
             value = external_values.get(field_name)
@@ -251,7 +573,7 @@ class import_sugarcrm(import_base):
                  'name': concat('name', 'first_name_c', 'last_name_c'),
                 'is_company': const('1'),
                 'date': fixdate('date_entered'),
-                'active': lambda record: not record['deleted'],
+                'active': uses('deleted')(lambda record: not record['deleted']),
                  'user_id/.id': user_by_login('account_manager_2_c'),
                  'website': first('website', 'website_c'),
                 'phone':'company_phone_c',
@@ -276,7 +598,7 @@ class import_sugarcrm(import_base):
                 'id': xml_id(self.TABLE_ACCOUNT_LEAD, 'id'),
                 'partner_id/id': xml_id(self.TABLE_ACCOUNT, 'id'),
                  'name': concat('name', 'first_name_c', 'last_name_c'),
-                'active': lambda record: not record['deleted'],
+                'active': uses('deleted')(lambda record: not record['deleted']),
                 #'user_id/id': xml_id(self.TABLE_USER, 'assigned_user_id'),
 
                 'phone':first('phone_office', 'telephone_c', 'company_phone_c'),
@@ -344,8 +666,12 @@ class import_sugarcrm(import_base):
 #+---------------+----------+
 
     def table_contact(self):
-        t1 = merge(DataFrame(self.get_data('contacts')),
-                   DataFrame(self.get_data('contacts_cstm')),
+        if self.use_sql_joins():
+            q = sql_join(self, 'contacts', keys=['id']).join('contacts_cstm', 'id', 'id_c')
+            self.join_table_email(q)
+            return q.fetch()
+        t1 = merge(DataFrame(self.get_data('contacts', keys=['id'])),
+                   DataFrame(self.get_data('contacts_cstm', keys=['id_c'])),
                    left_on='id',
                    right_on='id_c'
         )
@@ -406,7 +732,7 @@ class import_sugarcrm(import_base):
 
                 'create_date': 'date_entered',
                 'write_date': 'date_modified',
-                'active': lambda record: not record['deleted'],
+                'active': uses('deleted')(lambda record: not record['deleted']),
                  #'user_id/id': xml_id(self.TABLE_USER, 'assigned_user_id'),
 
                 'city': 'city_c',
@@ -458,8 +784,11 @@ class import_sugarcrm(import_base):
 }]
         }
     def table_case(self):
-        t1 = merge(DataFrame(self.get_data('cases')),
-                   DataFrame(self.get_data('cases_cstm')),
+        if self.use_sql_joins():
+            q = sql_join(self, 'cases', keys=['id']).join('cases_cstm', 'id', 'id_c')
+            return q.fetch()
+        t1 = merge(DataFrame(self.get_data('cases', keys=['id'])),
+                   DataFrame(self.get_data('cases_cstm', keys=['id_c'])),
                    left_on='id',
                    right_on='id_c'
         )
@@ -484,6 +813,7 @@ class import_sugarcrm(import_base):
         'Provisional':'draft',
         'To be Invoiced':'to_be_invoiced',
         }
+    @uses('estimated_close_date_c', 'end_date_c')
     def field_estimated_close_date_c(self, external_values):
         estimated_close_date_c = external_values.get('estimated_close_date_c')
         date = external_values.get('end_date_c')
@@ -613,23 +943,26 @@ partner_participant_list
                     }
 
     def table_filter_modules(self, t, field_name='bean_module'):
-        newt = t[(t[field_name] == 'Accounts')|
-                (t[field_name] == 'Cases')|
-                (t[field_name] == 'Contacts')|
-                (t[field_name] == 'Notes')|
-                (t[field_name] == 'Emails')
-                ]
+        newt = t[t[field_name].isin(FILTER_MODULES)]
         return newt
 
+    def query_email(self):
+        return sql_join(self, 'emails', keys=['id']) \
+            .join('emails_text', 'id', 'email_id', how='left') \
+            .join('emails_beans', 'id', 'email_id', how='left', suffixes=('', '_emails_beans'), keys=['bean_module']) \
+            .where_in('bean_module', FILTER_MODULES)
+
     def table_email(self):
-        t1 = merge(DataFrame(self.get_data('emails')),
-                   DataFrame(self.get_data('emails_text')),
+        if self.use_sql_joins():
+            return self.query_email().fetch()
+        t1 = merge(DataFrame(self.get_data('emails', keys=['id'])),
+                   DataFrame(self.get_data('emails_text', keys=['email_id'])),
                    how='left',
                    left_on='id',
                    right_on='email_id'
         )
         t2 = merge(t1,
-                   DataFrame(self.get_data('emails_beans')),
+                   DataFrame(self.get_data('emails_beans', keys=['email_id', 'bean_module'])),
                    how='left',
                    left_on='id',
                    right_on='email_id',
@@ -639,6 +972,31 @@ partner_participant_list
         #t3 = t3[:100] # for debug
         return t3
 
+    def stream_email(self):
+        """
+            same as table_email, but emails are read by chunks
+            and joined with the rows of emails_text and emails_beans of the chunk only
+        """
+        if self.use_sql_joins():
+            for t in self.query_email().iter_fetch(self.get_stream_chunk_size()):
+                yield t
+            return
+        for emails in self.iter_data('emails', keys=['id']):
+            t1 = merge(emails,
+                       self.get_data_in('emails_text', 'email_id', emails['id']),
+                       how='left',
+                       left_on='id',
+                       right_on='email_id'
+            )
+            t2 = merge(t1,
+                       self.get_data_in('emails_beans', 'email_id', emails['id'], keys=['bean_module']),
+                       how='left',
+                       left_on='id',
+                       right_on='email_id',
+                       suffixes = ('', '_emails_beans')
+            )
+            yield self.table_filter_modules(t2)
+
     map_to_model = {
         'Accounts': 'res.partner',
         'Cases': 'project.project',
@@ -686,7 +1044,8 @@ partner_participant_list
 # 6 rows in set (0.56 sec)
         return {
             'name': self.TABLE_EMAIL,
-            'table': self.table_email,
+            'table': self.get_stream_chunk_size() and self.stream_email or self.table_email,
+            'stream': bool(self.get_stream_chunk_size()),
             'dependencies' : [
                 self.TABLE_USER,
                 self.TABLE_ACCOUNT,
@@ -700,6 +1059,7 @@ partner_participant_list
              'models':[{
                 'model' : 'mail.message',
                  'hook': self.hook_email,
+                 'prepare': self.prepare_email,
 'fields': {
                 'id': xml_id(self.TABLE_EMAIL, 'id'),
                  'type':const('email'),
@@ -727,7 +1087,7 @@ partner_participant_list
                  'subject':'name',
                  'date':'date_sent',
                  'message_id': 'message_id',
-                 'body': call(lambda vals, html, txt: fix_email(html or txt or ''),
+                 'body': call(uses()(lambda vals, html, txt: fix_email(html or txt or '')),
                               value('description_html'), value('description')),
                  'subtype_id/id':const('mail.mt_comment'),
                 'notified_partner_ids/.id': emails2partners('to_addrs'),
@@ -744,20 +1104,69 @@ partner_participant_list
                     }
 
     def table_note(self):
-        t = DataFrame(self.get_data('notes'))
+        if self.use_sql_joins():
+            return sql_join(self, 'notes', keys=['parent_type', 'filename']) \
+                .where_in('parent_type', FILTER_MODULES) \
+                .where_not_null('filename') \
+                .fetch()
+        t = DataFrame(self.get_data('notes', keys=['parent_type', 'filename']))
         t = self.table_filter_modules(t, 'parent_type')
         t = t.dropna(subset=['filename'])
         #t = t[:10] # for debug
         return t
 
     def table_note_internal(self):
-        t = DataFrame(self.get_data('notes'))
+        if self.use_sql_joins():
+            return sql_join(self, 'notes', keys=['parent_type']) \
+                .where_in('parent_type', [m for m in FILTER_MODULES if m != 'Emails']) \
+                .fetch()
+        t = DataFrame(self.get_data('notes', keys=['parent_type']))
         t = self.table_filter_modules(t, 'parent_type')
         t = t[(t['parent_type'] != 'Emails')]
         #t = t[:100] # for debug
         return t
 
+    def prepare_targets(self, records, fields, parent_field_name='parent_type'):
+        """
+            Resolve records referred by the batch at once for get_id_model:
+            external ids via import_base.resolve_xml_ids and
+            projects by analytic accounts with one search.
+            @param fields: list of (field_name, parent type or None to take it from parent_field_name)
+        """
+        pairs = []
+        for field_name, parent_type in fields:
+            types = parent_type and [parent_type] * len(records) or records[parent_field_name]
+            pairs.extend((self.map_to_table.get(t, ''), external_id)
+                         for t, external_id in zip(types, records[field_name]))
+        self.targets = self.resolve_xml_ids(pairs)
+
+        account_ids = list(set(id for (table, external_id), id in self.targets.items()
+                               if id and table == self.TABLE_CASE))
+        self.projects = {}
+        if account_ids:
+            for r in self.pool['project.project'].search_read(self.cr, self.uid, [('analytic_account_id', 'in', account_ids)],
+                                                              ['analytic_account_id'], context=self.context):
+                self.projects.setdefault(r['analytic_account_id'][0], r['id'])
+
+    def prepare_email(self, records):
+        self.prepare_targets(records, [('bean_id', None)], parent_field_name='bean_module')
+
+    def prepare_note(self, records):
+        self.prepare_targets(records, [('parent_id', None), ('contact_id', 'Contacts')])
+
     def get_id_model(self, external_values, field_name='parent_id', parent_field_name='parent_type'):
+        """
+            @return: (res_id, model) of record referred by field_name.
+                     Records resolved by prepare_targets are taken from memory.
+        """
+        model = map_val(parent_field_name, self.map_to_model)
+        model = model(external_values)
+        key = (self.map_to_table.get(external_values.get(parent_field_name), ''), external_values.get(field_name))
+        if key in self.targets:
+            id = self.targets[key] or 0
+            if model=='project.project':
+                id = self.projects.get(id, 0)
+            return str(id),model
         id = res_id(map_val(parent_field_name, self.map_to_table), field_name)
         id.set_parent(self)
         id = id(external_values)
@@ -769,6 +1178,7 @@ partner_participant_list
                 id=id[0]
         return str(id),model
 
+    @uses('bean_id', 'bean_module')
     def hook_email(self, external_values):
         id,model = self.get_id_model(external_values, field_name='bean_id', parent_field_name='bean_module')
         external_values['res_id']=id
@@ -776,6 +1186,7 @@ partner_participant_list
         return external_values
 
 
+    @uses('parent_type', 'contact_id', 'parent_id')
     def hook_note(self, external_values):
         parent_type = external_values.get('parent_type')
         contact_id = external_values.get('contact_id')
@@ -814,6 +1225,7 @@ partner_participant_list
                 'model': 'ir.attachment',
                 'context': lambda : {'active_test':False, 'quick_import':True},
                 'hook': self.hook_note,
+                'prepare': self.prepare_note,
                 'finalize': self.finalize_note,
 'fields': {
                 'id': xml_id(self.TABLE_NOTE, 'id'),
@@ -824,7 +1236,7 @@ partner_participant_list
                 'res_model_tmp': const('mail.message'),
                 'res_id_tmp': res_id(map_val('parent_type', self.map_note_to_table, default=self.TABLE_NOTE_INTERNAL), 'id'),
 
-                'store_fname': call(lambda external_values, id_value: 'sugarcrm_files/' + id_value,
+                'store_fname': call(uses()(lambda external_values, id_value: 'sugarcrm_files/' + id_value),
                                     value('id')),
                 'type':const('binary'),
                 #'description': 'description',
@@ -844,12 +1256,13 @@ partner_participant_list
             'models':[{
                 'model': 'mail.message',
                 'hook': self.hook_note,
+                'prepare': self.prepare_note,
 'fields': {
                 'id': xml_id(self.TABLE_NOTE_INTERNAL, 'id'),
 
 
                 'subject':concat('name', 'filename', 'date_entered', delimiter=' * '),
-                'body': call(lambda vals, body: fix_email(body or ''),
+                'body': call(uses()(lambda vals, body: fix_email(body or '')),
                              value('description')),
                 'model': 'res_model',
                  'res_id': 'res_id',
@@ -0,0 +1,250 @@
+# -*- coding: utf-8 -*-
+"""
+    Reader of mysqldump files, so dumps are imported without MySQL server.
+
+    Run it to check a dump:
+
+        python mysqldump.py dump.sql [TABLE ...]
+"""
+import re
+import datetime
+import logging
+_logger = logging.getLogger(__name__)
+
+
+_CREATE_TABLE = re.compile(r'CREATE TABLE `([^`]+)`')
+_COLUMN = re.compile(r'\s+`([^`]+)`\s+(\w+)')
+_INSERT = re.compile(r'(?:INSERT|REPLACE)(?:\s+IGNORE)?\s+INTO\s+`([^`]+)`\s*(?:\(([^)]*)\)\s*)?VALUES\s*', re.I)
+_SPACE = re.compile(r'\s*')
+_STRING_BODY = r"[^'\\]*(?:(?:\\.|'')[^'\\]*)*"
+_VALUE = re.compile(r"(?:_binary\s*)?'(%s)'|(NULL)|(0x[0-9A-Fa-f]*)|([-+0-9.eE]+)" % _STRING_BODY, re.S)
+_ESCAPE = re.compile(r"\\(.)|''", re.S)
+_ESCAPES = {'0': '\0', 'b': '\b', 'n': '\n', 'r': '\r', 't': '\t', 'Z': '\x1a'}
+
+DATETIME_TYPES = ('datetime', 'timestamp')
+
+
+class incomplete_statement(Exception):
+    pass
+
+
+def unescape(s):
+    if '\\' not in s and "''" not in s:
+        return s
+    return _ESCAPE.sub(lambda m: m.group(1) is None and "'" or _ESCAPES.get(m.group(1), m.group(1)), s)
+
+
+def parse_number(s):
+    try:
+        return int(s)
+    except ValueError:
+        return float(s)
+
+
+def parse_values(text, pos=0):
+    """
+        parse "(v1, v2), (v3, v4);" of INSERT statement
+        @return: list of tuples
+        @raise incomplete_statement: if text ends before ';'
+    """
+    rows = []
+    end = len(text)
+    while True:
+        pos = _SPACE.match(text, pos).end()
+        if pos >= end:
+            raise incomplete_statement()
+        if text[pos] != '(':
+            raise ValueError('mysqldump: "(" expected at %s: %r' % (pos, text[pos:pos + 50]))
+        pos += 1
+        row = []
+        while True:
+            pos = _SPACE.match(text, pos).end()
+            m = _VALUE.match(text, pos)
+            if not m or m.end() >= end:
+                # string is cut or nothing after the value
+                raise incomplete_statement()
+            string, null, binary, number = m.groups()
+            if string is not None:
+                row.append(unescape(string).decode('utf-8'))
+            elif null:
+                row.append(None)
+            elif binary is not None:
+                row.append(binary[2:].decode('hex'))
+            else:
+                row.append(parse_number(number))
+            pos = _SPACE.match(text, m.end()).end()
+            if pos >= end:
+                raise incomplete_statement()
+            if text[pos] == ',':
+                pos += 1
+                continue
+            if text[pos] == ')':
+                pos += 1
+                break
+            raise ValueError('mysqldump: "," or ")" expected at %s: %r' % (pos, text[pos:pos + 50]))
+        rows.append(tuple(row))
+        pos = _SPACE.match(text, pos).end()
+        if pos >= end:
+            raise incomplete_statement()
+        if text[pos] == ',':
+            pos += 1
+            continue
+        if text[pos] == ';':
+            return rows
+        raise ValueError('mysqldump: "," or ";" expected at %s: %r' % (pos, text[pos:pos + 50]))
+
+
+def parse_datetime(value):
+    if not value or value.startswith('0000-00-00'):
+        # MySQLdb returns None for zero dates
+        return None
+    try:
+        return datetime.datetime.strptime(value, '%Y-%m-%d %H:%M:%S')
+    except ValueError:
+        return value
+
+
+def parse_date(value):
+    if not value or value.startswith('0000-00-00'):
+        return None
+    try:
+        return datetime.datetime.strptime(value, '%Y-%m-%d').date()
+    except ValueError:
+        return value
+
+
+class mysqldump_reader(object):
+    """
+        Reads rows of tables from mysqldump files (CREATE TABLE and INSERT statements).
+
+        Files are scanned once: columns of each table are taken from
+        CREATE TABLE and positions of INSERT statements are remembered.
+        Then a table is read by seeking to its statements only.
+
+        Values are converted like MySQLdb does: numbers, NULL as None,
+        strings as unicode, datetime/date columns as datetime/date.
+    """
+    def __init__(self, files):
+        self.files = list(files)
+        self.table_columns = {}
+        self.column_types = {}
+        self.statements = {}
+        for f in self.files:
+            self._scan(f)
+
+    def _scan(self, filename):
+        _logger.info('mysqldump: scan %s' % filename)
+        with open(filename, 'rb') as fd:
+            table = None
+            while True:
+                offset = fd.tell()
+                line = fd.readline()
+                if not line:
+                    break
+                if table:
+                    m = _COLUMN.match(line)
+                    if m:
+                        self.table_columns[table].append(m.group(1))
+                        self.column_types[table].append(m.group(2).lower())
+                    elif line.startswith(')'):
+                        table = None
+                    continue
+                if line.startswith('CREATE TABLE'):
+                    table = _CREATE_TABLE.match(line).group(1)
+                    self.table_columns[table] = []
+                    self.column_types[table] = []
+                    continue
+                m = _INSERT.match(line)
+                if m:
+                    self.statements.setdefault(m.group(1), []).append((filename, offset))
+                    if not line.rstrip().endswith(');'):
+                        # values with line breaks, read up to the end of statement
+                        self._read_statement(fd, line)
+
+    def _read_statement(self, fd, line):
+        text = line
+        m = _INSERT.match(text)
+        while True:
+            try:
+                return m, parse_values(text, m.end())
+            except incomplete_statement:
+                more = fd.readline()
+                if not more:
+                    raise ValueError('mysqldump: unexpected end of file in INSERT INTO %s' % m.group(1))
+                text += more
+
+    def tables(self):
+        return [t for t in self.table_columns]
+
+    def columns(self, table):
+        if table not in self.table_columns:
+            raise KeyError('mysqldump: table %s is not found in %s' % (table, ', '.join(self.files)))
+        return self.table_columns[table]
+
+    def _converters(self, table, columns):
+        types = dict(zip(self.table_columns[table], self.column_types[table]))
+        res = []
+        for c in columns:
+            t = types.get(c)
+            if t in DATETIME_TYPES:
+                res.append(parse_datetime)
+            elif t == 'date':
+                res.append(parse_date)
+            else:
+                res.append(None)
+        return res
+
+    def iter_rows(self, table, columns=None):
+        """
+            @param columns: columns to return, all columns by default
+            @return: iterator of tuples of values in order of columns
+        """
+        table_columns = self.columns(table)
+        columns = columns or table_columns
+        converters = self._converters(table, columns)
+        for filename, offset in self.statements.get(table, []):
+            with open(filename, 'rb') as fd:
+                fd.seek(offset)
+                m, rows = self._read_statement(fd, fd.readline())
+            names = m.group(2) and [c.strip().strip('`') for c in m.group(2).split(',')] or table_columns
+            positions = [names.index(c) for c in columns]
+            for row in rows:
+                yield tuple(convert(row[p]) if convert else row[p]
+                            for p, convert in zip(positions, converters))
+
+    def iter_chunks(self, table, chunk_size, columns=None):
+        """
+            @return: iterator of lists of chunk_size (at most) rows
+        """
+        chunk = []
+        for row in self.iter_rows(table, columns):
+            chunk.append(row)
+            if len(chunk) >= chunk_size:
+                yield chunk
+                chunk = []
+        if chunk:
+            yield chunk
+
+    def read(self, table, columns=None):
+        return list(self.iter_rows(table, columns))
+
+
+if __name__ == '__main__':
+    import sys
+    import time
+    logging.basicConfig(level=logging.INFO)
+    if len(sys.argv) < 2:
+        sys.exit(__doc__)
+    start = time.time()
+    reader = mysqldump_reader([sys.argv[1]])
+    print 'scanned in %.2f s' % (time.time() - start)
+    for table in sys.argv[2:] or sorted(reader.tables()):
+        start = time.time()
+        count = 0
+        first = None
+        for row in reader.iter_rows(table):
+            first = first or row
+            count += 1
+        print '%s: %s columns, %s rows, %.2f s' % (table, len(reader.columns(table)), count, time.time() - start)
+        if first:
+            print '    %r' % (dict(zip(reader.columns(table), first)),)
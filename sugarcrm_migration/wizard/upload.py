@@ -37,7 +37,7 @@ class sugarcrm_migration_upload(osv.TransientModel):
     _columns = {
         'sugarcrm_file': fields.char('Sugarcrm file (*.tar.gz)', help='Path on server'),
         'kashflow_file': fields.char('Kashflow file (*.tar.gz)', help='Path on server'),
-        'db_host': fields.char('MySQL Host'),
+        'db_host': fields.char('MySQL Host', help='Leave empty to read dumps without MySQL server'),
         'db_port': fields.char('MySQL Port'),
         'db_name': fields.char('MySQL Database'),
         'db_user': fields.char('MySQL User'),
@@ -53,58 +53,77 @@ class sugarcrm_migration_upload(osv.TransientModel):
     def upload_button(self, cr, uid, ids, context=None):
 
         record = self.browse(cr, uid, ids[0])
-
-        self.kashflow(record, cr, uid)
-        #self.sugarcrm(record, cr, uid)
-
-        return True
-
-    def sugarcrm(self, record, cr, uid):
-        #if not record.sugarcrm_file:
+        if not record.kashflow_file:
+            return True
+
+        # import is run in background, see import_framework.job
+        return self.pool['import_framework.job'].enqueue(cr, uid, 'kashflow', self._name, 'kashflow_job',
+                                                         {'kashflow_file': record.kashflow_file},
+                                                         context=context)
+        # params of job are visible in its form, so MySQL credentials
+        # are read from the wizard record in sugarcrm_job
+        #return self.pool['import_framework.job'].enqueue(cr, uid, 'sugarcrm', self._name, 'sugarcrm_job',
+        #                                                 {'sugarcrm_file': record.sugarcrm_file,
+        #                                                  'upload_id': record.id,
+        #                                                  }, context=context)
+
+    def sugarcrm_job(self, cr, uid, params, context=None):
+        """
+            @return: import_sugarcrm instance for import_framework.job
+        """
+        #if not params.get('sugarcrm_file'):
         #    return
 
         #unzip files
         files = []
         tmp_dir = None
-        if record.sugarcrm_file:
-            tmp_dir,files = self.unzip_file(record.sugarcrm_file.strip())
+        if params.get('sugarcrm_file'):
+            tmp_dir,files = self.unzip_file(params['sugarcrm_file'].strip())
+
+        db = {}
+        if params.get('upload_id'):
+            record = self.browse(cr, uid, params['upload_id'], context=context)
+            if not record.exists():
+                raise osv.except_osv(_('Error'), _('Upload wizard is removed, start the import again'))
+            db = self.read(cr, uid, record.id, ['db_host', 'db_port', 'db_user', 'db_passwd', 'db_name'], context=context)
 
         instance = import_sugarcrm(self.pool, cr, uid,
                                    'sugarcrm', #instance_name
                                    'sugarcrm_migration', # module_name
-                                   context={'db_host': record.db_host,
-                                            'db_port': record.db_port,
-                                            'db_user': record.db_user,
-                                            'db_passwd': record.db_passwd,
-                                            'db_name': record.db_name,
+                                   resume=params.get('resume', False),
+                                   context={'db_host': db.get('db_host'),
+                                            'db_port': db.get('db_port'),
+                                            'db_user': db.get('db_user'),
+                                            'db_passwd': db.get('db_passwd'),
+                                            'db_name': db.get('db_name'),
                                             'db_dump_fies': files
                                             }
                                    )
-        try:
-            shutil.rmtree(tmp_dir)
-        except:
-            pass
-        
-        instance.run()
+        if tmp_dir:
+            # dump files are read during the import, see mysqldump_reader
+            instance.cleanup = lambda: shutil.rmtree(tmp_dir, ignore_errors=True)
         return instance
 
-    def kashflow(self, record, cr, uid):
-        if not record.kashflow_file:
+    def kashflow_job(self, cr, uid, params, context=None):
+        """
+            @return: import_kashflow instance for import_framework.job
+        """
+        if not params.get('kashflow_file'):
             return
 
         # unzip files
-        tmp,files = self.unzip_file(record.kashflow_file.strip(), pattern='*.csv')
+        tmp,files = self.unzip_file(params['kashflow_file'].strip(), pattern='*.csv')
         _logger.info('kashflow files: %s'%files)
 
         # map data and save to base_import.import
         instance = import_kashflow(self.pool, cr, uid,
                                    'kashflow', #instance_name
                                    'sugarcrm_migration', #module_name
+                                   resume=params.get('resume', False),
                                    context = {'csv_files': files,
                                               'sugarcrm_instance_name':'sugarcrm'
                                               }
                                    )
-        instance.run()
         return instance
 
 